@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+"""
+Asyncio client for the Snapshot API (Cloud, SDK or container-api).
+
+A single process can keep hundreds of calls in flight without a thread per
+call. The number of concurrent calls is capped with a semaphore and the rate
+of calls is kept under the plan limit with a token bucket.
+"""
+
+import asyncio
+import json
+import sys
+from collections import OrderedDict, deque
+from pathlib import Path
+from timeit import default_timer
+
+try:
+    import aiohttp
+except ImportError:
+    print(
+        "A dependency is missing. Please install: "
+        "https://docs.aiohttp.org/en/stable/#library-installation"
+    )
+    exit(1)
+
+from plate_recognition import (
+    ApiClient,
+    add_rate_limit_arguments,
+    build_request,
+    make_rate_limiter,
+    open_result_writer,
+    parse_arguments,
+    retry_delay,
+)
+
+
+class AsyncRecognitionClient:
+    """
+    Same parameters and routing as plate_recognition.recognition_api
+
+    :param concurrency: maximum number of calls in flight
+    :param limiter: RateLimiter keeping the calls under the plan limit
+    """
+
+    def __init__(
+        self,
+        api_key=None,
+        sdk_url=None,
+        concurrency=100,
+        limiter=None,
+        retries=5,
+        timeout=60,
+        backoff=0.5,
+        max_backoff=30.0,
+    ):
+        self.api_key = api_key
+        self.sdk_url = sdk_url
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.limiter = limiter
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._session = None
+
+    async def __aenter__(self):
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._session.close()
+
+    @staticmethod
+    def _form(field, image, filename, data):
+        form = aiohttp.FormData()
+        for key, value in (data or {}).items():
+            for item in value if isinstance(value, list) else [value]:
+                form.add_field(key, str(item))
+        form.add_field(field, image, filename=filename)
+        return form
+
+    async def recognition(
+        self,
+        image,
+        regions=None,
+        config=None,
+        camera_id=None,
+        timestamp=None,
+        mmc=None,
+        filename="image.jpg",
+    ):
+        """
+        Send an image to the API
+
+        :param image: image file content
+        :return: API response, the error is printed if the call failed
+        """
+        url, field, data, headers = build_request(
+            regions, self.api_key, self.sdk_url, config, camera_id, timestamp, mmc
+        )
+        async with self._semaphore:
+            for attempt in range(self.retries + 1):
+                if self.limiter:
+                    await asyncio.sleep(self.limiter.reserve())
+                try:
+                    async with self._session.post(
+                        url,
+                        data=self._form(field, image, filename, data),
+                        headers=headers,
+                    ) as response:
+                        if (
+                            response.status in ApiClient.RETRY_STATUSES
+                            and attempt < self.retries
+                        ):
+                            delay = retry_delay(
+                                attempt,
+                                response.headers.get("Retry-After"),
+                                self.backoff,
+                                self.max_backoff,
+                            )
+                        else:
+                            text = await response.text()
+                            if response.status < 200 or response.status > 300:
+                                print(text)
+                            return json.loads(text, object_pairs_hook=OrderedDict)
+                except (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError):
+                    # Like ApiClient, a call that timed out waiting for the
+                    # response is not sent and charged again
+                    if attempt == self.retries:
+                        raise
+                    delay = retry_delay(attempt, None, self.backoff, self.max_backoff)
+                await asyncio.sleep(delay)
+
+
+async def recognize_file(client, path, args, engine_config):
+    now = default_timer()
+    image = await asyncio.get_running_loop().run_in_executor(None, path.read_bytes)
+    result = await client.recognition(
+        image,
+        args.regions,
+        engine_config,
+        camera_id=args.camera_id,
+        mmc=args.mmc,
+        filename=path.name,
+    )
+    return result, (default_timer() - now) * 1000
+
+
+async def recognize_files(args, paths, engine_config):
+    """
+    Yield (path, result, latency) in the same order as paths while keeping at
+    most 2 x concurrency files in memory.
+    """
+    async with AsyncRecognitionClient(
+        args.api_key, args.sdk_url, args.concurrency, make_rate_limiter(args)
+    ) as client:
+        pending = deque()
+        for path in paths:
+            if len(pending) >= 2 * args.concurrency:
+                done_path, task = pending.popleft()
+                yield (done_path, *(await task))
+            pending.append(
+                (
+                    path,
+                    asyncio.ensure_future(
+                        recognize_file(client, path, args, engine_config)
+                    ),
+                )
+            )
+        while pending:
+            done_path, task = pending.popleft()
+            yield (done_path, *(await task))
+
+
+async def run(args, engine_config):
+    paths = [path for path in args.files if path.is_file()]
+    writer = open_result_writer(args) if args.output_file else None
+    results = []
+    started = default_timer()
+    i = 0
+    try:
+        async for path, result, latency in recognize_files(args, paths, engine_config):
+            i += 1
+            if writer:
+                writer.write(result)
+            else:
+                results.append(result)
+            print(
+                f"[{i}/{len(paths)}] {path} {latency:.1f}ms "
+                f"({i / (default_timer() - started):.1f} images/s)",
+                file=sys.stderr,
+            )
+    finally:
+        if writer:
+            writer.close()
+    if not args.output_file:
+        print(json.dumps(results, indent=2))
+
+
+def custom_args(parser):
+    parser.epilog += """
+Keep 200 calls in flight to a Snapshot SDK:
+  async_recognition.py -s http://localhost:8080 --concurrency 200 /path/to/vehicle-*.jpg
+Stay under a Cloud plan limit of 8 calls per second:
+  async_recognition.py -a MY_API_KEY --rate 8 -o data.jsonl --format jsonl /path/to/vehicle-*.jpg"""
+    parser.add_argument("--engine-config", help="Engine configuration.")
+    parser.add_argument("-o", "--output-file", type=Path, help="Save result to file.")
+    parser.add_argument(
+        "--format",
+        help="Format of the result.",
+        default="json",
+        choices="json jsonl csv".split(),
+    )
+    parser.add_argument(
+        "--mmc",
+        action="store_true",
+        help="Predict vehicle make and model. Only available to paying users.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=100,
+        help="Maximum number of calls in flight.",
+    )
+    add_rate_limit_arguments(parser)
+
+
+def main():
+    args = parse_arguments(custom_args)
+    engine_config = {}
+    if args.engine_config:
+        try:
+            engine_config = json.loads(args.engine_config)
+        except json.JSONDecodeError as e:
+            print(e)
+            return
+    if args.output_file and not args.output_file.parent.exists():
+        print(f"{args.output_file} does not exist")
+        return
+    asyncio.run(run(args, engine_config))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+"""
+Common JSON result format of the benchmarks and comparison of two runs.
+
+benchmark_snapshot.py, benchmark_stream.py and video-editor/benchmark_video_blur.py
+write their results with --json:
+
+  {
+    "schema": 1,
+    "benchmark": "snapshot",
+    "created": "2024-01-01T00:00:00+00:00",
+    "host": {"hostname": ..., "platform": ..., "python": ..., "cpus": ..., "memory": ...},
+    "sdk_version": "1.3.17",
+    "arguments": {...},
+    "results": [
+      {
+        "image": "car-4k.jpg",
+        "resolution": "800x600",
+        "config": {"mode": "fast"},
+        "rate": null,
+        "latency": {"min": ..., "mean": ..., "p50": ..., "p90": ..., "p99": ..., "p99.9": ..., "max": ...},
+        "samples": [...],
+        "throughput": ...,
+        "errors": ...,
+        "cpu": ...,
+        "rss": ...
+      }
+    ]
+  }
+
+Latencies are in milliseconds, throughput in calls per second, errors and cpu
+in percent and rss in bytes.
+
+Compare a run with a baseline, for example before and after an SDK upgrade:
+
+  python -m benchmark.bench_report compare before.json after.json
+
+The exit code is 1 when a latency is significantly higher than the baseline.
+"""
+
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import socket
+from statistics import mean
+
+import requests
+
+SCHEMA_VERSION = 1
+PERCENTILES = [50, 90, 99, 99.9]
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of sorted values
+    """
+    if not values:
+        return math.nan
+    return values[max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))]
+
+
+def latency_summary(samples):
+    samples = sorted(samples)
+    if not samples:
+        return dict.fromkeys(["min", "mean", "max"] + [f"p{p:g}" for p in PERCENTILES])
+    summary = dict(min=samples[0], mean=mean(samples), max=samples[-1])
+    for p in PERCENTILES:
+        summary[f"p{p:g}"] = percentile(samples, p)
+    return summary
+
+
+def make_result(
+    samples,
+    image=None,
+    resolution=None,
+    config=None,
+    rate=None,
+    throughput=None,
+    errors=0.0,
+    cpu=None,
+    rss=None,
+):
+    """
+    One measured configuration.
+
+    :param samples: latencies in milliseconds
+    """
+    return dict(
+        image=image and os.path.basename(image),
+        resolution=resolution,
+        config=config or {},
+        rate=rate,
+        latency=latency_summary(samples),
+        samples=list(samples),
+        throughput=throughput,
+        errors=errors,
+        cpu=cpu,
+        rss=rss,
+    )
+
+
+def cpu_usage(since):
+    """
+    Percentage of the CPUs used since the psutil.cpu_times() snapshot since
+    """
+    import psutil
+
+    now = psutil.cpu_times()
+    total = sum(now) - sum(since)
+    if total <= 0:
+        return 0.0
+    return (1 - (now.idle - since.idle) / total) * 100
+
+
+def host_info():
+    try:
+        import psutil
+
+        memory = psutil.virtual_memory().total
+    except ImportError:
+        memory = None
+    return dict(
+        hostname=socket.gethostname(),
+        platform=platform.platform(),
+        python=platform.python_version(),
+        cpus=os.cpu_count(),
+        memory=memory,
+    )
+
+
+def sdk_version(sdk_url):
+    """
+    Version reported by the /info/ endpoint of the Snapshot SDK, None if it
+    is not available.
+    """
+    try:
+        response = requests.get(sdk_url.rstrip("/") + "/info/", timeout=10)
+        return response.json().get("version") if response.ok else None
+    except (requests.RequestException, ValueError, AttributeError):
+        return None
+
+
+def make_report(benchmark, args, results, version=None):
+    return dict(
+        schema=SCHEMA_VERSION,
+        benchmark=benchmark,
+        created=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        host=host_info(),
+        sdk_version=version,
+        arguments=vars(args),
+        results=results,
+    )
+
+
+def write_report(path, report):
+    with open(path, "w") as fp:
+        json.dump(report, fp, indent=2)
+
+
+def read_report(path):
+    with open(path) as fp:
+        report = json.load(fp)
+    if report.get("schema") != SCHEMA_VERSION:
+        raise ValueError(f"{path}: unsupported schema {report.get('schema')}")
+    return report
+
+
+def result_key(result):
+    """
+    Identify the same measurement in two runs
+    """
+    return json.dumps(
+        [result["image"], result["resolution"], result["config"], result["rate"]],
+        sort_keys=True,
+    )
+
+
+def result_name(result):
+    parts = [result["image"], result["resolution"]]
+    parts += [f"{k}={v}" for k, v in sorted(result["config"].items())]
+    if result["rate"] is not None:
+        parts.append(f"rate={result['rate']:g}")
+    return " ".join(str(part) for part in parts if part is not None)
+
+
+def mann_whitney(a, b):
+    """
+    Two-sided p-value of the Mann-Whitney U test, with the normal
+    approximation. It does not assume that latencies are normally distributed.
+    """
+    n1, n2 = len(a), len(b)
+    if n1 < 2 or n2 < 2:
+        return math.nan
+    values = sorted([(x, 0) for x in a] + [(x, 1) for x in b])
+    n = n1 + n2
+    rank_sum = 0.0
+    ties = 0.0
+    i = 0
+    while i < n:
+        j = i
+        while j + 1 < n and values[j + 1][0] == values[i][0]:
+            j += 1
+        rank = (i + j) / 2 + 1
+        rank_sum += rank * sum(1 for k in range(i, j + 1) if values[k][1] == 0)
+        t = j - i + 1
+        ties += t**3 - t
+        i = j + 1
+    u = rank_sum - n1 * (n1 + 1) / 2
+    sigma = math.sqrt(n1 * n2 / 12 * ((n + 1) - ties / (n * (n - 1))))
+    if sigma == 0:
+        return 1.0
+    z = (abs(u - n1 * n2 / 2) - 0.5) / sigma
+    return math.erfc(max(z, 0) / math.sqrt(2))
+
+
+def compare(baseline, current, alpha=0.05, threshold=5.0):
+    """
+    :param alpha: significance level of the whole comparison, it is divided by
+        the number of measurements (Bonferroni correction) so that a run with
+        many measurements does not report regressions by chance
+    :param threshold: smallest change of the median latency, in percent, that
+        is reported as a regression or an improvement
+    :return: one row per measurement of current
+    """
+    previous = {result_key(result): result for result in baseline["results"]}
+    rows = []
+    pairs = []
+    for result in current["results"]:
+        before = previous.get(result_key(result))
+        row = dict(name=result_name(result), after=result["latency"]["p50"])
+        rows.append(row)
+        if before is None:
+            row.update(before=None, change=None, p=None, verdict="new")
+            continue
+        row["before"] = before["latency"]["p50"]
+        if not row["before"] or row["after"] is None:
+            row.update(change=None, p=None, verdict="no data")
+            continue
+        row["change"] = (row["after"] / row["before"] - 1) * 100
+        row["p"] = mann_whitney(before["samples"], result["samples"])
+        pairs.append((row, before, result))
+    alpha /= max(1, sum(not math.isnan(row["p"]) for row, _, _ in pairs))
+    for row, before, result in pairs:
+        if math.isnan(row["p"]):
+            verdict = "too few samples"
+        elif row["p"] >= alpha or abs(row["change"]) < threshold:
+            verdict = "same"
+        elif row["change"] > 0:
+            verdict = "REGRESSION"
+        else:
+            verdict = "improvement"
+        if result["errors"] > before["errors"] + threshold:
+            verdict = "REGRESSION"
+        row["verdict"] = verdict
+    return rows
+
+
+def print_comparison(baseline, current, rows):
+    print(
+        f"Baseline: {baseline['benchmark']} SDK {baseline['sdk_version']} "
+        f"on {baseline['host']['hostname']} at {baseline['created']}"
+    )
+    print(
+        f"Current:  {current['benchmark']} SDK {current['sdk_version']} "
+        f"on {current['host']['hostname']} at {current['created']}"
+    )
+    print("| Measurement | p50 before | p50 after | Change | p-value | Verdict |")
+    print("| ----------- | ---------- | --------- | ------ | ------- | ------- |")
+
+    def number(value, spec):
+        return "-" if value is None or math.isnan(value) else format(value, spec)
+
+    for row in rows:
+        print(
+            f"| {row['name']} | {number(row['before'], '.1f')} "
+            f"| {number(row['after'], '.1f')} | {number(row['change'], '+.1f')}% "
+            f"| {number(row['p'], '.3f')} | {row['verdict']} |"
+        )
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark results.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compare_parser = subparsers.add_parser(
+        "compare", help="Compare a run with a baseline."
+    )
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument(
+        "--alpha",
+        default=0.05,
+        type=float,
+        help="Significance level of the Mann-Whitney U tests, for all the "
+        "measurements together.",
+    )
+    compare_parser.add_argument(
+        "--threshold",
+        default=5.0,
+        type=float,
+        help="Ignore changes of the median latency below this percentage.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    baseline = read_report(args.baseline)
+    current = read_report(args.current)
+    rows = compare(baseline, current, args.alpha, args.threshold)
+    print_comparison(baseline, current, rows)
+    if any(row["verdict"] == "REGRESSION" for row in rows):
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
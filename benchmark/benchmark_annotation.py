@@ -0,0 +1,144 @@
+import argparse
+import math
+import random
+from pathlib import Path
+from timeit import default_timer
+
+from PIL import Image, ImageDraw, ImageFont
+
+from plate_recognition import draw_bb, text_function
+
+ASSETS = Path(__file__).resolve().parent.parent / "assets"
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the annotation of images with draw_bb."
+    )
+    parser.add_argument("--iterations", default=20, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument(
+        "--images",
+        type=Path,
+        nargs="+",
+        default=[ASSETS / "demo.jpg", ASSETS / "cars-4k.jpg"],
+    )
+    return parser.parse_args()
+
+
+def legacy_draw_bb(im, data, new_size=(1920, 1050), text_func=None):
+    """
+    draw_bb before the font cache: the font is loaded for every image and
+    the outline is drawn with 3 rectangles.
+    """
+    draw = ImageDraw.Draw(im)
+    font_path = ASSETS / "DejaVuSansMono.ttf"
+    if font_path.exists():
+        font = ImageFont.truetype(str(font_path), 10)
+    else:
+        font = ImageFont.load_default()
+    rect_color = (0, 255, 0)
+    for result in data:
+        b = result["box"]
+        coord = [(b["xmin"], b["ymin"]), (b["xmax"], b["ymax"])]
+        draw.rectangle(coord, outline=rect_color)
+        draw.rectangle(
+            ((coord[0][0] - 1, coord[0][1] - 1), (coord[1][0] - 1, coord[1][1] - 1)),
+            outline=rect_color,
+        )
+        draw.rectangle(
+            ((coord[0][0] - 2, coord[0][1] - 2), (coord[1][0] - 2, coord[1][1] - 2)),
+            outline=rect_color,
+        )
+        if text_func:
+            text = text_func(result)
+            (text_width, text_height) = font.font.getsize(text)[0]
+            margin = math.ceil(0.05 * text_height)
+            draw.rectangle(
+                [
+                    (b["xmin"] - margin, b["ymin"] - text_height - 2 * margin),
+                    (b["xmin"] + text_width + 2 * margin, b["ymin"]),
+                ],
+                fill="white",
+            )
+            draw.text(
+                (b["xmin"] + margin, b["ymin"] - text_height - margin),
+                text,
+                fill="black",
+                font=font,
+            )
+    if new_size:
+        im = im.resize(new_size)
+    return im
+
+
+def make_results(count, width, height, rng):
+    results = []
+    for _ in range(count):
+        x = rng.randint(20, max(20, width - 140))
+        y = rng.randint(20, max(20, height - 60))
+        plate = "".join(
+            rng.choice("ABCDEFGHJKLMNPRSTUVWXYZ0123456789") for _ in range(6)
+        )
+        results.append(
+            dict(plate=plate, box=dict(xmin=x, ymin=y, xmax=x + 120, ymax=y + 40))
+        )
+    return results
+
+
+def duration(func, image, results, iterations):
+    """
+    :return: milliseconds per image, the copy of the image is not measured
+    """
+    total = 0.0
+    for _ in range(iterations):
+        im = image.copy()
+        now = default_timer()
+        func(im, results, None, text_function)
+        total += default_timer() - now
+    return total * 1000 / iterations
+
+
+def print_table(results):
+    if not results:
+        return
+    print(
+        "| Image | Megapixels | Boxes | Before (ms) | After (ms) | Before (MP/s) | After (MP/s) |"
+    )
+    print(
+        "| ----- | ---------- | ----- | ----------- | ---------- | ------------- | ------------ |"
+    )
+    for result in results:
+        print(
+            "| {image} | {mp:.1f} | {boxes} | {before:.2f} | {after:.2f} | "
+            "{before_mps:.0f} | {after_mps:.0f} |".format(**result)
+        )
+
+
+def benchmark(args):
+    rng = random.Random(args.seed)
+    for path in args.images:
+        image = Image.open(path).convert("RGB")
+        megapixels = image.width * image.height / 1e6
+        for boxes in [5, 50]:
+            results = make_results(boxes, image.width, image.height, rng)
+            before = duration(legacy_draw_bb, image, results, args.iterations)
+            after = duration(draw_bb, image, results, args.iterations)
+            yield dict(
+                image=path.name,
+                mp=megapixels,
+                boxes=boxes,
+                before=before,
+                after=after,
+                before_mps=megapixels / before * 1000,
+                after_mps=megapixels / after * 1000,
+            )
+
+
+def main():
+    args = parse_arguments()
+    print_table(list(benchmark(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import argparse
+import random
+from functools import partial
+from timeit import default_timer
+
+from box_utils import (
+    _suppress_contained_py,
+    _suppress_overlaps_py,
+    suppress_contained,
+    suppress_overlaps,
+)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the filtering of merged split-image detections."
+    )
+    parser.add_argument("--iterations", default=20, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    return parser.parse_args()
+
+
+def print_table(results):
+    if not results:
+        return
+    print("| Detections | Python (ms) | NumPy (ms) | Speedup |")
+    print("| ---------- | ----------- | ---------- | ------- |")
+    for result in results:
+        print(
+            "| {count:10d} | {python:11.2f} | {numpy:10.2f} | {speedup:6.1f}x |".format(
+                **result
+            )
+        )
+
+
+def make_detections(plates, tiles, rng, width=3840, height=2160):
+    """
+    Simulate the detections of a dense image split in tiles.
+    Every plate is found by several tiles with some jitter.
+    """
+    boxes = []
+    scores = []
+    for _ in range(plates):
+        x = rng.uniform(0, width - 120)
+        y = rng.uniform(0, height - 40)
+        for _ in range(rng.randint(1, tiles)):
+            dx, dy = rng.uniform(-4, 4), rng.uniform(-4, 4)
+            boxes.append(
+                dict(
+                    xmin=int(x + dx),
+                    ymin=int(y + dy),
+                    xmax=int(x + dx) + 120,
+                    ymax=int(y + dy) + 40,
+                )
+            )
+            scores.append(round(rng.uniform(0.05, 1), 3))
+    return boxes, scores
+
+
+def filter_detections(boxes, scores, overlaps, contained):
+    keep = overlaps(boxes, scores, 0.1)
+    boxes = [boxes[i] for i in keep]
+    scores = [scores[i] for i in keep]
+    return [keep[i] for i in contained(boxes, scores, 0.2)]
+
+
+def duration(func, iterations):
+    now = default_timer()
+    for _ in range(iterations):
+        result = func()
+    return (default_timer() - now) * 1000 / iterations, result
+
+
+def benchmark(args):
+    rng = random.Random(args.seed)
+    for plates in [10, 50, 100, 250, 500]:
+        boxes, scores = make_detections(plates, 4, rng)
+        python, expected = duration(
+            partial(
+                filter_detections,
+                boxes,
+                scores,
+                _suppress_overlaps_py,
+                _suppress_contained_py,
+            ),
+            args.iterations,
+        )
+        numpy, survivors = duration(
+            partial(
+                filter_detections, boxes, scores, suppress_overlaps, suppress_contained
+            ),
+            args.iterations,
+        )
+        if survivors != expected:
+            raise Exception(f"Different survivors for {len(boxes)} detections")
+        yield dict(count=len(boxes), python=python, numpy=numpy, speedup=python / numpy)
+
+
+def main():
+    args = parse_arguments()
+    print_table(list(benchmark(args)))
+
+
+if __name__ == "__main__":
+    main()
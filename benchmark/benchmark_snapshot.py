@@ -1,16 +1,31 @@
 import argparse
 import math
+import random
+import threading
+import time
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from statistics import mean
 from timeit import default_timer
 
 import psutil
-import requests
 from PIL import Image
 from psutil import cpu_percent, process_iter
 
-from plate_recognition import recognition_api
+from benchmark.bench_report import (
+    cpu_usage,
+    make_report,
+    make_result,
+    percentile,
+    sdk_version,
+    write_report,
+)
+from plate_recognition import (
+    build_request,
+    configure_client,
+    get_client,
+    recognition_api,
+)
 
 
 def parse_arguments():
@@ -27,12 +42,47 @@ def parse_arguments():
     parser.add_argument("--mmc", action="store_true")
     parser.add_argument("--iterations", default=50, type=int)
     parser.add_argument("--blur", action="store_true")
+    parser.add_argument(
+        "--rate",
+        type=float,
+        help="Open-loop mode: send this many calls per second instead of "
+        "--iterations calls back to back. Latency is measured from the time each "
+        "call should have been sent, so queueing is included.",
+    )
+    parser.add_argument(
+        "--duration", default=30, type=float, help="Seconds of each open-loop run."
+    )
+    parser.add_argument(
+        "--arrival",
+        default="fixed",
+        choices=["fixed", "poisson"],
+        help="Fixed interval between calls or Poisson arrivals.",
+    )
+    parser.add_argument(
+        "--ramp-to",
+        type=float,
+        help="Repeat the open-loop run from --rate up to this rate to find the "
+        "saturation point.",
+    )
+    parser.add_argument(
+        "--ramp-step", default=1, type=float, help="Rate increment of --ramp-to."
+    )
+    parser.add_argument(
+        "--json",
+        help="Also write the results to this file, see benchmark/bench_report.py.",
+    )
     return parser.parse_args()
 
 
+RESOLUTIONS = [(800, 600), (1280, 720), (1920, 1080), (2560, 1440), (3840, 2160)]
+
+
 def print_table(results):
     if not results:
         return
+    if "rate" in results[0]:
+        print_open_loop_table(results)
+        return
     print("| Mode     | Resolution | Speed   | l_min  | l_max  |")
     print("| -------- | ---------- | ------- | ------ | ------ |")
     for result in results:
@@ -43,11 +93,28 @@ def print_table(results):
         )
 
 
+def print_open_loop_table(results):
+    print(
+        "| Mode     | Resolution | Rate   | Throughput | Errors | p50    "
+        "| p90    | p99    | p99.9  |"
+    )
+    print(
+        "| -------- | ---------- | ------ | ---------- | ------ | ------ "
+        "| ------ | ------ | ------ |"
+    )
+    for result in results:
+        print(
+            "| {mode:8s} | {resolution:10s} | {rate:6.1f} | {throughput:10.1f} "
+            "| {errors:5.1f}% | {p50:6.1f} | {p90:6.1f} | {p99:6.1f} "
+            "| {p999:6.1f} |".format(**result)
+        )
+
+
 def blur_api(url, fp):
     """
     Upload an Image to url for burring
     """
-    response = requests.post(url, files={"upload": fp})
+    response = get_client().post(url, files={"upload": fp})
     if response.status_code < 200 or response.status_code > 300:
         if response.status_code == 400:
             msg = response.json().get("error")
@@ -76,19 +143,119 @@ def call_duration(path, sdk_url, config, mmc, blur):
     return (default_timer() - now) * 1000
 
 
+def call_succeeded(path, sdk_url, config, mmc, blur):
+    """
+    Same call as call_duration, failures are reported instead of raised
+    """
+    with open(path, "rb") as fp:
+        if blur:
+            response = get_client().post(sdk_url, files={"upload": fp})
+        else:
+            url, field, data, headers = build_request(
+                None, None, sdk_url, config, None, None, "true" if mmc else "false"
+            )
+            response = get_client().post(
+                url, files={field: fp}, data=data, headers=headers
+            )
+    return 200 <= response.status_code <= 300
+
+
+def arrival_times(rate, duration, poisson, rng):
+    """
+    Seconds after the start at which each call must be sent
+    """
+    t = 0.0
+    while t < duration:
+        yield t
+        t += rng.expovariate(rate) if poisson else 1 / rate
+
+
+def open_loop(call, rate, duration, poisson, executor, rng):
+    """
+    Send calls at rate whatever the response time, like independent clients.
+
+    :return: latencies of the successful calls in milliseconds, number of
+        failed calls, seconds until the last call completed
+    """
+    latencies = []
+    failures = 0
+    lock = threading.Lock()
+    start = default_timer()
+
+    def timed_call(intended):
+        nonlocal failures
+        try:
+            ok = call()
+        except Exception:
+            ok = False
+        end = default_timer()
+        with lock:
+            if ok:
+                latencies.append((end - intended) * 1000)
+            else:
+                failures += 1
+        return end
+
+    futures = []
+    for t in arrival_times(rate, duration, poisson, rng):
+        delay = start + t - default_timer()
+        if delay > 0:
+            time.sleep(delay)
+        futures.append(executor.submit(timed_call, start + t))
+    end = max([f.result() for f in futures], default=start)
+    return sorted(latencies), failures, end - start
+
+
+def benchmark_open_loop(args, executor):
+    rng = random.Random(0)
+    rates = [args.rate]
+    while args.ramp_to and rates[-1] + args.ramp_step <= args.ramp_to:
+        rates.append(rates[-1] + args.ramp_step)
+    image = Image.open(args.image)
+    for resolution in RESOLUTIONS:
+        image.resize(resolution).save("/tmp/platerec-benchmark.jpg")
+        configs = [{}] if args.blur else [{}, dict(mode="fast")]
+        for config in configs:
+            call = partial(
+                call_succeeded,
+                "/tmp/platerec-benchmark.jpg",
+                sdk_url=args.sdk_url,
+                config=config,
+                mmc=args.mmc,
+                blur=args.blur,
+            )
+            for rate in rates:
+                cpu_times = psutil.cpu_times()
+                latencies, failures, elapsed = open_loop(
+                    call, rate, args.duration, args.arrival == "poisson", executor, rng
+                )
+                total = len(latencies) + failures
+                yield dict(
+                    resolution=f"{resolution[0]}x{resolution[1]}",
+                    mode=config.get("mode", "regular"),
+                    config=config,
+                    samples=latencies,
+                    cpu=cpu_usage(cpu_times),
+                    rss=sdk_rss(),
+                    rate=rate,
+                    throughput=len(latencies) / elapsed if elapsed else 0,
+                    errors=failures / total * 100 if total else 0,
+                    p50=percentile(latencies, 50),
+                    p90=percentile(latencies, 90),
+                    p99=percentile(latencies, 99),
+                    p999=percentile(latencies, 99.9),
+                )
+
+
 def benchmark(args, executor):
     image = Image.open(args.image)
-    for resolution in [
-        (800, 600),
-        (1280, 720),
-        (1920, 1080),
-        (2560, 1440),
-        (3840, 2160),
-    ]:
+    for resolution in RESOLUTIONS:
         image.resize(resolution).save("/tmp/platerec-benchmark.jpg")
         configs = [{}] if args.blur else [{}, dict(mode="fast")]
 
         for config in configs:
+            cpu_times = psutil.cpu_times()
+            now = default_timer()
             stats = list(
                 executor.map(
                     partial(
@@ -101,9 +268,16 @@ def benchmark(args, executor):
                     ["/tmp/platerec-benchmark.jpg"] * args.iterations,
                 )
             )
+            elapsed = default_timer() - now
             yield dict(
                 resolution=f"{resolution[0]}x{resolution[1]}",
                 mode=config.get("mode", "regular"),
+                config=config,
+                samples=stats,
+                cpu=cpu_usage(cpu_times),
+                rss=sdk_rss(),
+                throughput=len(stats) / elapsed,
+                errors=0.0,
                 min=min(stats),
                 max=max(stats),
                 avg=mean(stats),
@@ -121,6 +295,35 @@ def mem_usage():
     return usage
 
 
+def sdk_rss():
+    return sum(mem.rss for mem in mem_usage().values())
+
+
+def json_report(args, results):
+    """
+    Results in the format of benchmark/bench_report.py
+    """
+    return make_report(
+        "snapshot-blur" if args.blur else "snapshot",
+        args,
+        [
+            make_result(
+                result["samples"],
+                image=args.image,
+                resolution=result["resolution"],
+                config=result["config"],
+                rate=result.get("rate"),
+                throughput=result["throughput"],
+                errors=result["errors"],
+                cpu=result["cpu"],
+                rss=result["rss"],
+            )
+            for result in results
+        ],
+        None if args.blur else sdk_version(args.sdk_url),
+    )
+
+
 def convert_size(size_bytes):
     if size_bytes == 0:
         return "0B"
@@ -139,6 +342,8 @@ def main():
     args = parse_arguments()
     initial_mem = mem_usage()
     cpu_percent()  # first time this is called it will return a meaningless 0.0
+    # Each measurement is a single call, errors are not hidden by retries
+    configure_client(pool_size=args.threads, retries=0)
     with ThreadPoolExecutor(max_workers=args.threads) as executor:
         # Warmup
         list(
@@ -154,7 +359,10 @@ def main():
             )
         )
         # Benchmark
-        results = list(benchmark(args, executor))
+        if args.rate:
+            results = list(benchmark_open_loop(args, executor))
+        else:
+            results = list(benchmark(args, executor))
 
     # Memory Usage
     print(f"CPU: {cpu_percent()}%")
@@ -165,6 +373,8 @@ def main():
             f"SHR {convert_size(mem.shared):10} ({convert_size(mem.shared - initial_mem[pid].shared):10})"
         )
     print_table(results)
+    if args.json:
+        write_report(args.json, json_report(args, results))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,230 @@
+"""
+Benchmark of the --split-image pipeline (tiling, merge, NMS) without a live SDK.
+
+The SDK responses of the fixture images are recorded once, then replayed by
+a local stub server so that the pipeline can be measured offline and its
+output compared with the golden output of the recording.
+
+  python -m benchmark.benchmark_split --record --sdk-url http://localhost:8080
+  python -m benchmark.benchmark_split
+"""
+
+import argparse
+import contextlib
+import copy
+import io
+import json
+import tracemalloc
+from functools import partial
+from pathlib import Path
+from timeit import default_timer
+
+from benchmark.sdk_stub import Fixtures, start_server
+from plate_recognition import (
+    ImageContext,
+    clean_objs,
+    configure_client,
+    custom_args,
+    offset_results,
+    parse_arguments,
+    post_processing,
+    process_split_image,
+    recognition_api,
+    recognize_tiles,
+    split_tiles,
+)
+
+ASSETS = Path(__file__).resolve().parent.parent / "assets"
+FIXTURES = Path(__file__).resolve().parent / "fixtures" / "split"
+
+
+def parse_benchmark_arguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the split-image pipeline with recorded responses."
+    )
+    parser.add_argument(
+        "--images",
+        type=Path,
+        nargs="+",
+        default=[ASSETS / "cars-4k.jpg", ASSETS / "demo.jpg"],
+    )
+    parser.add_argument("--fixtures", type=Path, default=FIXTURES)
+    parser.add_argument(
+        "--record",
+        action="store_true",
+        help="Record the responses of --sdk-url and the golden output.",
+    )
+    parser.add_argument("-s", "--sdk-url", help="SDK used when recording.")
+    parser.add_argument("-a", "--api-key", help="API key used when recording.")
+    parser.add_argument("--split-x", type=int, default=2)
+    parser.add_argument("--split-y", type=int, default=2)
+    parser.add_argument("--split-overlap", type=int, default=10)
+    parser.add_argument("--split-workers", type=int, default=4)
+    parser.add_argument("--iterations", type=int, default=5)
+    return parser.parse_args()
+
+
+def pipeline_arguments(url, args, path):
+    """
+    plate_recognition.py arguments for one image sent to the stub
+    """
+    return parse_arguments(
+        custom_args,
+        [
+            "--sdk-url",
+            url,
+            "--split-image",
+            "--split-x",
+            str(args.split_x),
+            "--split-y",
+            str(args.split_y),
+            "--split-overlap",
+            str(args.split_overlap),
+            "--split-workers",
+            str(args.split_workers),
+            str(path),
+        ],
+    )
+
+
+def run_pipeline(path, pipeline_args):
+    # Hide the per-image encoding report
+    with contextlib.redirect_stderr(io.StringIO()):
+        return json.loads(json.dumps(process_split_image(path, pipeline_args, {})))
+
+
+def record(args, url):
+    golden = {}
+    for path in args.images:
+        golden[path.name] = run_pipeline(path, pipeline_arguments(url, args, path))
+        print(f"Recorded {path}")
+    (args.fixtures / "golden.json").write_text(json.dumps(golden, indent=2))
+
+
+def tile_predictions(path, pipeline_args):
+    """
+    Responses of the stub for the entire image and each tile, as they are
+    passed to merge_results by process_split_image
+    """
+    context = ImageContext(path)
+    tiles = split_tiles(context.image.width, context.image.height, pipeline_args)
+    images = [((0, 0), context.original or context.image)] + [
+        (offset, context.image.crop(box)) for offset, box in tiles
+    ]
+    return recognize_tiles(
+        images,
+        partial(recognition_api, sdk_url=pipeline_args.sdk_url),
+        pipeline_args.split_workers,
+    )
+
+
+def stage_times(predictions, iterations):
+    """
+    :return: milliseconds spent moving the detections to the image coordinates,
+        in NMS (clean_objs) and in post_processing
+    """
+    merge = nms = post = 0.0
+    for _ in range(iterations):
+        data = copy.deepcopy(predictions)
+        now = default_timer()
+        detections = offset_results(data)
+        merge += default_timer() - now
+        now = default_timer()
+        detections = clean_objs(detections)
+        nms += default_timer() - now
+        now = default_timer()
+        post_processing(dict(results=detections))
+        post += default_timer() - now
+    return [t * 1000 / iterations for t in (merge, nms, post)]
+
+
+def peak_memory(path, pipeline_args):
+    tracemalloc.start()
+    try:
+        run_pipeline(path, pipeline_args)
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark(args, url, golden):
+    for path in args.images:
+        pipeline_args = pipeline_arguments(url, args, path)
+        result = run_pipeline(path, pipeline_args)
+        now = default_timer()
+        for _ in range(args.iterations):
+            run_pipeline(path, pipeline_args)
+        elapsed = (default_timer() - now) / args.iterations
+        predictions = tile_predictions(path, pipeline_args)
+        merge, nms, post = stage_times(predictions, args.iterations)
+        yield dict(
+            image=path.name,
+            tiles=len(predictions),
+            tiles_per_second=len(predictions) / elapsed,
+            latency=elapsed * 1000,
+            merge=merge,
+            nms=nms,
+            post=post,
+            memory=peak_memory(path, pipeline_args),
+            golden="match" if golden.get(path.name) == result else "DRIFT",
+        )
+
+
+def print_table(results):
+    print(
+        "| Image | Tiles | Tiles/s | ms/image | Merge (ms) | NMS (ms) "
+        "| Post-processing (ms) | Peak memory (MB) | Golden |"
+    )
+    print(
+        "| ----- | ----- | ------- | -------- | ---------- | -------- "
+        "| -------------------- | ---------------- | ------ |"
+    )
+    for result in results:
+        print(
+            "| {image} | {tiles} | {tiles_per_second:.1f} | {latency:.1f} "
+            "| {merge:.3f} | {nms:.3f} | {post:.3f} | {memory:.1f} | {golden} |".format(
+                **result
+            )
+        )
+
+
+def main():
+    args = parse_benchmark_arguments()
+    responses = args.fixtures / "responses.json"
+    golden_path = args.fixtures / "golden.json"
+    if args.record:
+        if not args.sdk_url:
+            print("--sdk-url is required to record responses.")
+            exit(1)
+        fixtures = Fixtures(responses)
+        fixtures.entries = []
+    elif not responses.exists() or not golden_path.exists():
+        print(
+            f"No recorded responses in {args.fixtures}. Record them first with: "
+            "python -m benchmark.benchmark_split --record --sdk-url http://localhost:8080"
+        )
+        exit(1)
+    else:
+        fixtures = Fixtures(responses)
+
+    server = start_server(
+        fixtures, record_url=args.sdk_url if args.record else None, api_key=args.api_key
+    )
+    url = f"http://127.0.0.1:{server.server_port}"
+    configure_client(pool_size=args.split_workers)
+    try:
+        if args.record:
+            args.fixtures.mkdir(parents=True, exist_ok=True)
+            record(args, url)
+            fixtures.save()
+            return
+        results = list(benchmark(args, url, json.loads(golden_path.read_text())))
+    finally:
+        server.shutdown()
+    print_table(results)
+    if any(result["golden"] != "match" for result in results):
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
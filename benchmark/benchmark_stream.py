@@ -5,9 +5,12 @@ from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from timeit import default_timer
 
+import psutil
 import requests
 from psutil import cpu_percent, process_iter
 
+from benchmark.bench_report import cpu_usage, make_report, make_result, write_report
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Benchmark Stream.")
@@ -18,6 +21,10 @@ def parse_arguments():
     )
     parser.add_argument("--video", default="assets/cars.mp4")
     parser.add_argument("--iterations", default=5, type=int)
+    parser.add_argument(
+        "--json",
+        help="Also write the results to this file, see benchmark/bench_report.py.",
+    )
     return parser.parse_args()
 
 
@@ -50,6 +57,7 @@ def call_duration(path, stream_url):
 
 
 def benchmark(args, executor):
+    cpu_times = psutil.cpu_times()
     now = default_timer()
     stats = list(
         executor.map(
@@ -58,7 +66,15 @@ def benchmark(args, executor):
         )
     )
     duration = (default_timer() - now) * 1000
-    yield dict(min=min(stats), max=max(stats), avg=duration / args.iterations)
+    yield dict(
+        min=min(stats),
+        max=max(stats),
+        avg=duration / args.iterations,
+        samples=stats,
+        throughput=args.iterations / duration * 1000,
+        cpu=cpu_usage(cpu_times),
+        rss=sum(mem.rss for mem in mem_usage().values()),
+    )
 
 
 def mem_usage():
@@ -69,6 +85,26 @@ def mem_usage():
     return usage
 
 
+def json_report(args, results):
+    """
+    Results in the format of benchmark/bench_report.py
+    """
+    return make_report(
+        "stream",
+        args,
+        [
+            make_result(
+                result["samples"],
+                image=args.video,
+                throughput=result["throughput"],
+                cpu=result["cpu"],
+                rss=result["rss"],
+            )
+            for result in results
+        ],
+    )
+
+
 def convert_size(size_bytes):
     if size_bytes == 0:
         return "0B"
@@ -106,6 +142,8 @@ def main():
             f"SHR {convert_size(mem.shared):10} ({convert_size(mem.shared - initial_mem[pid].shared):10})"
         )
     print_table(results)
+    if args.json:
+        write_report(args.json, json_report(args, results))
 
 
 if __name__ == "__main__":
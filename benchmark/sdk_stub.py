@@ -0,0 +1,425 @@
+"""
+Local stand-in for the Snapshot SDK (/v1/plate-reader/) and Blur (/v1/blur).
+
+It is used to load test the clients and to measure their overhead without a
+real SDK. Responses are:
+- synthetic by default: one plate in the middle of the image, the plate
+  number is derived from the image content so responses are deterministic,
+- replayed with --fixtures: the response of the recorded image closest to the
+  upload is returned. The fingerprint is the image size and a small grayscale
+  thumbnail, so tiles that are encoded slightly differently still match,
+- recorded with --fixtures and --record: requests are forwarded to a real SDK
+  (or the Cloud API) and each response is stored with the fingerprint.
+
+Latency, errors and rate limiting (429 with Retry-After) can be injected:
+
+  python -m benchmark.sdk_stub --port 8081 --latency lognormal:80:0.5 --error-rate 0.01 --throttle-rate 0.05
+  python -m benchmark.sdk_stub --fixtures responses.json --record http://localhost:8080
+  python -m benchmark.sdk_stub --fixtures responses.json --max-calls-per-second 8
+"""
+
+import argparse
+import base64
+import hashlib
+import io
+import json
+import math
+import random
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from email.parser import BytesParser
+from email.policy import default
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import requests
+from PIL import Image
+
+THUMBNAIL_SIZE = (8, 8)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Fake Snapshot SDK and Blur server for load and regression tests."
+    )
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument(
+        "--fixtures", type=Path, help="Replay or record responses in this file."
+    )
+    parser.add_argument(
+        "--record", help="Forward requests to this SDK URL and record the responses."
+    )
+    parser.add_argument("--api-key", help="API key used when recording.")
+    parser.add_argument(
+        "--latency",
+        default="fixed:0",
+        help="Response time in milliseconds: fixed:MS, uniform:MIN:MAX, "
+        "normal:MEAN:STDDEV, exponential:MEAN or lognormal:MEDIAN:SIGMA.",
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="Fraction of failed calls."
+    )
+    parser.add_argument(
+        "--error-status", type=int, default=500, help="Status of failed calls."
+    )
+    parser.add_argument(
+        "--throttle-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of calls rejected with 429.",
+    )
+    parser.add_argument(
+        "--max-calls-per-second",
+        type=float,
+        help="Reject calls above this rate with 429, like a plan limit.",
+    )
+    parser.add_argument(
+        "--retry-after", type=int, default=1, help="Retry-After of 429 responses."
+    )
+    parser.add_argument(
+        "--seed", type=int, help="Seed of the injected latency and errors."
+    )
+    return parser.parse_args()
+
+
+def parse_latency(spec):
+    """
+    :param spec: distribution and its parameters in milliseconds, for example
+        uniform:20:80
+    :return: function returning a latency in seconds from a random.Random
+    """
+    name, *params = spec.split(":")
+    params = [float(p) for p in params]
+    distributions = dict(
+        fixed=lambda rng, ms: ms,
+        uniform=lambda rng, low, high: rng.uniform(low, high),
+        normal=lambda rng, mean, stddev: rng.gauss(mean, stddev),
+        exponential=lambda rng, mean: rng.expovariate(1 / mean) if mean else 0,
+        lognormal=lambda rng, median, sigma: rng.lognormvariate(
+            math.log(median), sigma
+        ),
+    )
+    if name not in distributions:
+        raise ValueError(f"Unknown latency distribution: {spec}")
+    distribution = distributions[name]
+    return lambda rng: max(0.0, distribution(rng, *params)) / 1000
+
+
+class Throttle:
+    """
+    Token bucket rejecting the calls above max_rate, like the plan limit
+    """
+
+    def __init__(self, max_rate):
+        self.max_rate = max_rate
+        self.tokens = max(1.0, max_rate)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                max(1.0, self.max_rate),
+                self.tokens + (now - self.updated) * self.max_rate,
+            )
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+def fingerprint(image_bytes):
+    im = Image.open(io.BytesIO(image_bytes))
+    thumbnail = im.convert("L").resize(THUMBNAIL_SIZE, Image.NEAREST)
+    return list(im.size), list(thumbnail.getdata())
+
+
+def parse_multipart(content_type, body):
+    """
+    :return: (form fields as a dict of lists, uploaded file name, file content)
+    """
+    message = BytesParser(policy=default).parsebytes(
+        b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body
+    )
+    fields = {}
+    filename, upload = None, None
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        if name in ("upload", "image"):
+            filename, upload = part.get_filename(), part.get_payload(decode=True)
+        else:
+            fields.setdefault(name, []).append(part.get_content().strip())
+    return fields, filename, upload
+
+
+class Fixtures:
+    """
+    Recorded responses and the fingerprint of their image
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries = []
+        self._lock = threading.Lock()
+        if self.path.exists():
+            self.entries = json.loads(self.path.read_text())
+
+    def add(self, image_bytes, response):
+        size, thumbnail = fingerprint(image_bytes)
+        with self._lock:
+            self.entries.append(dict(size=size, thumbnail=thumbnail, response=response))
+
+    def match(self, image_bytes):
+        size, thumbnail = fingerprint(image_bytes)
+        candidates = [e for e in self.entries if e["size"] == size]
+        if not candidates:
+            return None
+        best = min(
+            candidates,
+            key=lambda e: sum(abs(a - b) for a, b in zip(e["thumbnail"], thumbnail)),
+        )
+        return best["response"]
+
+    def save(self):
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.write_text(json.dumps(self.entries))
+
+
+def synthetic_response(upload, fields):
+    """
+    Deterministic response with one plate in the middle of the image
+    """
+    width, height = Image.open(io.BytesIO(upload)).size
+    plate = hashlib.sha1(upload).hexdigest()[:6].upper()
+    box = dict(
+        xmin=int(width * 0.45),
+        ymin=int(height * 0.48),
+        xmax=int(width * 0.55),
+        ymax=int(height * 0.52),
+    )
+    vehicle_box = dict(
+        xmin=int(width * 0.3),
+        ymin=int(height * 0.3),
+        xmax=int(width * 0.7),
+        ymax=int(height * 0.7),
+    )
+    return dict(
+        processing_time=50.0,
+        results=[
+            dict(
+                box=box,
+                plate=plate.lower(),
+                region=dict(code="us-ca", score=0.9),
+                score=0.9,
+                candidates=[dict(score=0.9, plate=plate.lower())],
+                dscore=0.9,
+                vehicle=dict(score=0.9, type="Sedan", box=vehicle_box),
+            )
+        ],
+        filename="upload.jpg",
+        version=1,
+        camera_id=fields.get("camera_id", [None])[0],
+        timestamp=fields.get("timestamp", ["2024-01-01T00:00:00.000000Z"])[0],
+    )
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.stats.add(status)
+
+    def read_form(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        return parse_multipart(self.headers["Content-Type"], body)
+
+    def do_GET(self):
+        # SDK version, as reported by the /info/ endpoint of the SDK
+        if self.path.rstrip("/").endswith("/info"):
+            self.send_json(200, dict(version="stub"))
+        else:
+            self.send_json(404, dict(error=f"Unknown path {self.path}"))
+
+    def do_POST(self):
+        path = self.path.rstrip("/")
+        if path.endswith("/v1/plate-reader"):
+            endpoint = self.plate_reader
+        elif path.endswith("/v1/blur"):
+            endpoint = self.blur
+        else:
+            self.send_json(404, dict(error=f"Unknown path {self.path}"))
+            return
+        fields, filename, upload = self.read_form()
+        if upload is None:
+            self.send_json(400, dict(error="upload is required"))
+            return
+        server = self.server
+        latency, rejection = server.injection()
+        time.sleep(latency)
+        if rejection == 429:
+            self.send_json(
+                429,
+                dict(detail="Request was throttled."),
+                {"Retry-After": str(server.retry_after)},
+            )
+        elif rejection:
+            self.send_json(rejection, dict(error="Injected error"))
+        else:
+            endpoint(fields, filename, upload)
+
+    def plate_reader(self, fields, filename, upload):
+        server = self.server
+        if server.record_url:
+            response = requests.post(
+                server.record_url.rstrip("/") + "/v1/plate-reader/",
+                files=dict(upload=(filename or "image.jpg", upload)),
+                data=fields,
+                headers=server.record_headers,
+                timeout=60,
+            )
+            if response.ok:
+                server.fixtures.add(upload, response.json())
+            self.send_json(response.status_code, response.json())
+            return
+        if server.fixtures is None:
+            self.send_json(201, synthetic_response(upload, fields))
+            return
+        result = server.fixtures.match(upload)
+        if result is None:
+            self.send_json(404, dict(error="No recorded response for this image"))
+        else:
+            self.send_json(201, result)
+
+    def blur(self, fields, filename, upload):
+        # The image is returned as is, only the client side is measured
+        result = synthetic_response(upload, fields)
+        result["blur"] = dict(base64=base64.b64encode(upload).decode())
+        self.send_json(200, result)
+
+
+class Stats:
+    def __init__(self):
+        self.statuses = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, status):
+        with self._lock:
+            self.statuses[status] += 1
+
+    def __str__(self):
+        total = sum(self.statuses.values())
+        details = ", ".join(f"{s}: {n}" for s, n in sorted(self.statuses.items()))
+        return f"{total} call(s) ({details})"
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        fixtures=None,
+        record_url=None,
+        api_key=None,
+        latency="fixed:0",
+        error_rate=0.0,
+        error_status=500,
+        throttle_rate=0.0,
+        max_rate=None,
+        retry_after=1,
+        seed=None,
+    ):
+        super().__init__(address, StubHandler)
+        self.fixtures = fixtures
+        self.record_url = record_url
+        self.record_headers = dict(Authorization=f"Token {api_key}") if api_key else {}
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.throttle_rate = throttle_rate
+        self.throttle = Throttle(max_rate) if max_rate else None
+        self.retry_after = retry_after
+        self.stats = Stats()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def injection(self):
+        """
+        :return: (latency in seconds, status of an injected failure or None)
+        """
+        with self._lock:
+            latency = self.latency(self._rng)
+            draw = self._rng.random()
+        if self.throttle and not self.throttle.allow():
+            return latency, 429
+        if draw < self.throttle_rate:
+            return latency, 429
+        if draw < self.throttle_rate + self.error_rate:
+            return latency, self.error_status
+        return latency, None
+
+
+def start_server(fixtures=None, port=0, record_url=None, api_key=None, **options):
+    """
+    Start the stub in a background thread
+
+    :param port: 0 to use a free port
+    :param options: latency and error injection, see StubServer
+    :return: server, its URL is f"http://127.0.0.1:{server.server_port}"
+    """
+    server = StubServer(("127.0.0.1", port), fixtures, record_url, api_key, **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    args = parse_arguments()
+    if args.record and not args.fixtures:
+        print("--fixtures is required to record responses.")
+        exit(1)
+    fixtures = Fixtures(args.fixtures) if args.fixtures else None
+    server = start_server(
+        fixtures,
+        args.port,
+        args.record,
+        args.api_key,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        throttle_rate=args.throttle_rate,
+        max_rate=args.max_calls_per_second,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+    print(f"Listening on http://127.0.0.1:{server.server_port}", flush=True)
+    # Stop cleanly when killed, for example by a load test script
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        print(server.stats)
+        if args.record:
+            fixtures.save()
+            print(f"Saved {len(fixtures.entries)} response(s) to {args.fixtures}")
+
+
+if __name__ == "__main__":
+    main()
@@ -25,6 +25,26 @@ class BlurError(Exception):
     pass
 
 
+class RateLimiter:
+    """
+    Token bucket keeping the calls under the plan limit, see plate_recognition.py
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def acquire(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate)
+
+
 def merge_paths(path1: Path, path2: Path):
     """
     This is path computation, No filesystem access
@@ -103,6 +123,8 @@ def process(args, path: Path, output: Path, logo=None):
             data["copy_metadata"] = "true"
         headers = {"Authorization": f"Token {args.api_key}"} if args.api_key else None
 
+        if args.limiter:
+            args.limiter.acquire()
         response = requests.post(
             args.blur_url,
             headers=headers,
@@ -247,7 +269,14 @@ Specify engine config and/or two regions:
         required=False,
         action="append",
     )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        required=False,
+        help="Maximum number of API calls per second, for example your plan limit.",
+    )
     args = parser.parse_args()
+    args.limiter = RateLimiter(args.rate) if args.rate else None
     if not args.images.is_dir():
         raise BlurError(
             f"Images directory is missing or invalid. Ensure path exists: {args.images}"
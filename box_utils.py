@@ -0,0 +1,129 @@
+"""
+Bounding box filtering shared by plate_recognition.py and number_plate_redaction.py
+
+Boxes are dicts with xmin, ymin, xmax and ymax keys as returned by the API.
+NumPy is used when it is installed, otherwise the pure Python implementation
+is used. Both return the same survivors.
+"""
+
+from itertools import combinations
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # type: ignore[assignment]
+
+
+def bb_iou(a, b):
+    # determine the (x, y)-coordinates of the intersection rectangle
+    x_a = max(a["xmin"], b["xmin"])
+    y_a = max(a["ymin"], b["ymin"])
+    x_b = min(a["xmax"], b["xmax"])
+    y_b = min(a["ymax"], b["ymax"])
+
+    # compute the area of both the prediction and ground-truth
+    # rectangles
+    area_a = (a["xmax"] - a["xmin"]) * (a["ymax"] - a["ymin"])
+    area_b = (b["xmax"] - b["xmin"]) * (b["ymax"] - b["ymin"])
+
+    # compute the area of intersection rectangle
+    area_inter = max(0, x_b - x_a) * max(0, y_b - y_a)
+    return area_inter / float(max(area_a + area_b - area_inter, 1))
+
+
+def inside(a, b):
+    return (
+        a["xmin"] > b["xmin"]
+        and a["ymin"] > b["ymin"]
+        and a["xmax"] < b["xmax"]
+        and a["ymax"] < b["ymax"]
+    )
+
+
+def box_array(boxes):
+    return np.array(
+        [(b["xmin"], b["ymin"], b["xmax"], b["ymax"]) for b in boxes], dtype=np.float64
+    ).reshape(-1, 4)
+
+
+def iou_matrix(boxes):
+    """
+    Pairwise IoU of an (n, 4) array of boxes, computed like bb_iou
+    """
+    xmin, ymin, xmax, ymax = boxes.T
+    area = (xmax - xmin) * (ymax - ymin)
+    width = np.maximum(
+        0, np.minimum(xmax[:, None], xmax) - np.maximum(xmin[:, None], xmin)
+    )
+    height = np.maximum(
+        0, np.minimum(ymax[:, None], ymax) - np.maximum(ymin[:, None], ymin)
+    )
+    inter = width * height
+    return inter / np.maximum(area[:, None] + area - inter, 1)
+
+
+def _suppress_overlaps_py(boxes, scores, threshold):
+    removed = [False] * len(boxes)
+    for i, j in combinations(range(len(boxes)), 2):
+        if removed[i] or removed[j] or bb_iou(boxes[i], boxes[j]) <= threshold:
+            continue
+        if scores[i] > scores[j]:
+            removed[j] = True
+        else:
+            removed[i] = True
+    return [i for i, r in enumerate(removed) if not r]
+
+
+def suppress_overlaps(boxes, scores, threshold=0.1):
+    """
+    Remove the lowest score box of every pair overlapping more than threshold.
+
+    Pairs are visited in the same order as itertools.combinations and a box
+    that was already removed does not remove other boxes. Only the pairs
+    that overlap are visited in Python, the IoU is computed on arrays.
+
+    :return: indices of the boxes to keep
+    """
+    if np is None or len(boxes) < 2:
+        return _suppress_overlaps_py(boxes, scores, threshold)
+    overlaps = np.triu(iou_matrix(box_array(boxes)) > threshold, k=1)
+    removed = [False] * len(boxes)
+    for i, j in np.argwhere(overlaps).tolist():
+        if removed[i] or removed[j]:
+            continue
+        if scores[i] > scores[j]:
+            removed[j] = True
+        else:
+            removed[i] = True
+    return [i for i, r in enumerate(removed) if not r]
+
+
+def _suppress_contained_py(boxes, scores, max_score):
+    return [
+        i
+        for i, box in enumerate(boxes)
+        if not (
+            scores[i] < max_score
+            and any(inside(other, box) for j, other in enumerate(boxes) if j != i)
+        )
+    ]
+
+
+def suppress_contained(boxes, scores, max_score=0.2):
+    """
+    Remove boxes with a score below max_score that contain another box.
+
+    :return: indices of the boxes to keep
+    """
+    if np is None or len(boxes) < 2:
+        return _suppress_contained_py(boxes, scores, max_score)
+    xmin, ymin, xmax, ymax = box_array(boxes).T
+    # contains[i, j] is True when box j is strictly inside box i
+    contains = (
+        (xmin > xmin[:, None])
+        & (ymin > ymin[:, None])
+        & (xmax < xmax[:, None])
+        & (ymax < ymax[:, None])
+    )
+    low_score = np.array(scores, dtype=np.float64) < max_score
+    return np.flatnonzero(~(low_score & contains.any(axis=1))).tolist()
@@ -4,18 +4,33 @@ import ftplib
 import json
 import logging
 import os
+import queue
+import sqlite3
+import stat
 import sys
 import tempfile
+import threading
 import time
 from abc import ABC, abstractmethod
 from collections.abc import Callable
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from ftplib import FTP, error_perm, error_reply
+from functools import partial
+from timeit import default_timer
 from typing import Any
 
 import paramiko
 
-from plate_recognition import recognition_api, save_results
+from plate_recognition import (
+    ResultWriter,
+    add_cache_arguments,
+    add_rate_limit_arguments,
+    close_cache,
+    configure_client,
+    make_rate_limiter,
+    open_cache,
+    recognition_api,
+)
 
 LOG_LEVEL = os.environ.get("LOGGING", "INFO").upper()
 
@@ -42,17 +57,132 @@ def get_files_and_dirs(
     return wrapper
 
 
+class StageStats:
+    """
+    Throughput of one stage of the download and recognition pipeline
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.size = 0
+        self.busy = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, seconds, size=0):
+        with self.lock:
+            self.count += 1
+            self.size += size
+            self.busy += seconds
+
+    def report(self, elapsed):
+        if not self.count or elapsed <= 0:
+            return f"{self.name}: 0 file(s)"
+        report = (
+            f"{self.name}: {self.count} file(s) in {elapsed:.1f}s, "
+            f"{self.count / elapsed:.1f} files/s, "
+        )
+        if self.size:
+            report += f"{self.size / elapsed / 1e6:.2f} MB/s, "
+        return report + f"{self.busy / self.count * 1000:.0f} ms/file"
+
+
+class SeenFiles:
+    """
+    Index of the remote files already processed, with their size and
+    modification time so that a file that is replaced is processed again.
+    It is kept between runs when path is a file.
+    """
+
+    def __init__(self, path=":memory:"):
+        # Shared by the camera workers
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        if path != ":memory:":
+            self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files "
+            "(path TEXT PRIMARY KEY, size INTEGER, modified TEXT, processed REAL)"
+        )
+        self.db.commit()
+
+    @staticmethod
+    def path(directory, name):
+        return f"{directory.rstrip('/')}/{name}"
+
+    def new_files(self, directory, files):
+        """
+        :param files: [name, last modified, size] of the files in directory
+        :return: the files that were not processed or changed since
+        """
+        prefix = self.path(directory, "")
+        # All the paths that start with prefix, in one range scan of the index
+        with self.lock:
+            seen = {
+                path: (size, modified)
+                for path, size, modified in self.db.execute(
+                    "SELECT path, size, modified FROM files "
+                    "WHERE path >= ? AND path < ?",
+                    (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)),
+                )
+            }
+        return [
+            info
+            for info in files
+            if seen.get(prefix + info[0]) != (info[2], str(info[1]))
+        ]
+
+    def add(self, directory, files):
+        now = time.time()
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                [
+                    (self.path(directory, info[0]), info[2], str(info[1]), now)
+                    for info in files
+                ],
+            )
+            self.db.commit()
+
+    def remove(self, path):
+        with self.lock:
+            self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
 class FileTransferProcessor(ABC):
+    # Camera workers output their results one at a time
+    output_lock = threading.Lock()
+
     def __init__(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
 
-        self.processed = []
+        self.kwargs = kwargs
+        self.seen = None
+        self.sink = None
+        self.download_connections = []
+
+    def clone(self):
+        """
+        New processor with the same settings and its own connection
+        """
+        processor = type(self)(**self.kwargs)
+        processor.seen = self.seen
+        processor.sink = self.sink
+        return processor
 
     @abstractmethod
     def connect(self):
         pass
 
+    @abstractmethod
+    def close(self):
+        pass
+
     @abstractmethod
     def delete_file(self, file):
         pass
@@ -79,6 +209,7 @@ class FileTransferProcessor(ABC):
 
     def processing_single_camera(self, args):
         self.set_working_directory(args.folder)
+        self.camera_id = args.camera_id
 
         file_list, dirs, nondirs = self.retrieve_files()
 
@@ -90,55 +221,15 @@ class FileTransferProcessor(ABC):
         self.process_files(nondirs)
 
         for folder in dirs:
-            folder_path = f"./{folder}"
+            # Don't process files any deeper
             self.camera_id = folder
-            self.set_working_directory(folder_path)
-            nondirs = []
-            file_list = self.list_files()
-
-        for info in file_list:
-            name = info[-1]
-            ls_type = info[0] if self.os_linux else info[-2]
-            if ls_type.startswith("d") or ls_type == "<DIR>":
-                # Don't process files any deeper
-                pass
-            else:
-                if self.os_linux:
-                    nondirs.append(
-                        [name, self.parse_date(info[-4], info[-3], info[-2])]
-                    )
-                else:
-                    file_date = info[0].split("-")
-                    file_time = info[1]
-
-                    if "AM" in file_time or "PM" in file_time:
-                        parsed_time = datetime.strptime(file_time, "%I:%M%p")
-                        file_time = parsed_time.strftime(
-                            "%H:%M"
-                        )  # from AM/PM to 24-hour format
-
-                    nondirs.append(
-                        [
-                            name,
-                            self.parse_date(
-                                file_date[0], file_date[1], file_time, linux=False
-                            ),
-                        ]
-                    )
-
-        logging.info(
-            "Found %s file(s) in %s.", len(nondirs), self.get_working_directory()
-        )
-        self.process_files(nondirs)
-
-    def track_processed(self):
-        """
-        Track processed is an interval specified
+            self.set_working_directory(f"{args.folder.rstrip('/')}/{folder}")
+            file_list, _, nondirs = self.retrieve_files()
 
-        :param self: FileTransferProcessor properties context
-        :return: Boolean
-        """
-        return self.interval and self.interval > 0 and not self.delete
+            logging.info(
+                "Found %s file(s) in %s.", len(nondirs), self.get_working_directory()
+            )
+            self.process_files(nondirs)
 
     def manage_processed_file(self, file, last_modified):
         """
@@ -155,43 +246,199 @@ class FileTransferProcessor(ABC):
             if "error" in result.lower():
                 print(f"file couldn't be deleted: {result}")
             else:
-                self.processed.remove(file)
+                self.seen.remove(self.seen.path(self.get_working_directory(), file))
 
-    def process_files(self, ftp_files):
-        results = []
-        for file_last_modified in ftp_files:
-            ftp_file = file_last_modified[0]
-            last_modified = file_last_modified[1]
+    def download(self, ftp_file):
+        """
+        :return: open temporary file with the content of ftp_file, it is kept
+            in memory unless it is larger than spool_size megabytes
+        """
+        image = tempfile.SpooledTemporaryFile(
+            max_size=self.spool_size * 1024 * 1024, suffix="_" + ftp_file
+        )
+        try:
+            self.set_ftp_binary_file(ftp_file, image)
+        except BaseException:
+            image.close()
+            raise
+        return image
+
+    def recognize(self, image, ftp_file):
+        return recognition_api(
+            image,
+            self.regions,
+            self.api_key,
+            self.sdk_url,
+            camera_id=self.camera_id,
+            timestamp=self.timestamp,
+            mmc=self.mmc,
+            exit_on_error=False,
+            filename=os.path.basename(ftp_file),
+        )
 
-            if self.delete is not None:
-                self.manage_processed_file(ftp_file, last_modified)
-                continue
+    def open_download_connections(self, count):
+        """
+        :return: up to count connections for the download workers, they are
+            opened once and reused for the following folders and batches
+        """
+        while len(self.download_connections) < count:
+            connection = self.clone()
+            try:
+                connection.connect()
+            except Exception as e:
+                logging.error(f"Download connection failed: {e}")
+                break
+            self.download_connections.append(connection)
+        return self.download_connections[:count]
+
+    def close_download_connections(self):
+        for connection in self.download_connections:
+            connection.close()
+        self.download_connections = []
 
+    def download_worker(self, connection, files, downloads, directory, stats):
+        """
+        Download files from connection in directory into downloads
+        """
+        connection.set_working_directory(directory)
+        while True:
+            try:
+                index, ftp_file = files.get_nowait()
+            except queue.Empty:
+                return
             logging.info(ftp_file)
+            start = default_timer()
+            try:
+                image = connection.download(ftp_file)
+            except Exception as e:
+                logging.error(f"Download of {ftp_file} failed: {e}")
+                continue
+            stats.add(default_timer() - start, image.tell())
+            downloads.put((index, ftp_file, image))
 
-            with tempfile.NamedTemporaryFile(
-                suffix="_" + ftp_file, mode="rb+"
-            ) as image:
-                self.set_ftp_binary_file(ftp_file, image)
-                api_res = recognition_api(
-                    image,
-                    self.regions,
-                    self.api_key,
-                    self.sdk_url,
-                    camera_id=self.camera_id,
-                    timestamp=self.timestamp,
-                    mmc=self.mmc,
-                    exit_on_error=False,
-                )
-                results.append(api_res)
+    def recognition_worker(self, downloads, record, stats):
+        while True:
+            item = downloads.get()
+            if item is None:
+                return
+            index, ftp_file, image = item
+            start = default_timer()
+            # Any error stays in this file, a dead worker would leave the
+            # download workers blocked on the full queue
+            try:
+                with image:
+                    result = self.recognize(image, ftp_file)
+                stats.add(default_timer() - start)
+                record(index, result)
+            except Exception as e:
+                logging.error(f"Recognition of {ftp_file} failed: {e}")
+
+    def process_pipelined(self, ftp_files, record):
+        """
+        Download with download_workers connections while recognition_workers
+        send the downloaded files to the API. At most queue_size files are
+        downloaded ahead of the recognition.
 
-            if self.track_processed():
-                self.processed.append(ftp_file)
+        :param record: called with the index in ftp_files and the result of each
+            file as soon as it is recognized, from the recognition threads
+        """
+        files = queue.Queue()
+        for index, ftp_file in enumerate(ftp_files):
+            files.put((index, ftp_file))
+        downloads = queue.Queue(self.queue_size)
+        download_stats = StageStats("Download")
+        recognition_stats = StageStats("Recognition")
+        directory = self.get_working_directory()
+
+        start = default_timer()
+        connections = self.open_download_connections(
+            min(self.download_workers, len(ftp_files))
+        )
+        downloaders = [
+            threading.Thread(
+                target=self.download_worker,
+                args=(connection, files, downloads, directory, download_stats),
+                name=f"download-{i}",
+            )
+            for i, connection in enumerate(connections)
+        ]
+        recognizers = [
+            threading.Thread(
+                target=self.recognition_worker,
+                args=(downloads, record, recognition_stats),
+                name=f"recognition-{i}",
+            )
+            for i in range(self.recognition_workers)
+        ]
+        for thread in downloaders + recognizers:
+            thread.start()
+        for thread in downloaders:
+            thread.join()
+        for _ in recognizers:
+            downloads.put(None)
+        for thread in recognizers:
+            thread.join()
+        elapsed = default_timer() - start
+
+        if not files.empty():
+            logging.error(f"{files.qsize()} file(s) not downloaded, no connection.")
+        logging.info(download_stats.report(elapsed))
+        logging.info(recognition_stats.report(elapsed))
 
-        if self.output_file:
-            save_results(results, self)
+    def process_files(self, ftp_files):
+        if self.delete is not None:
+            for file_last_modified in ftp_files:
+                ftp_file = file_last_modified[0]
+                last_modified = file_last_modified[1]
+                self.manage_processed_file(ftp_file, last_modified)
+            ftp_files = []
+
+        directory = self.get_working_directory()
+        count = len(ftp_files)
+        ftp_files = self.seen.new_files(directory, ftp_files)
+        if count > len(ftp_files):
+            logging.info(
+                "Skipped %s file(s) already processed.", count - len(ftp_files)
+            )
+
+        # Results are written to the sink as they come, they are only kept to
+        # print them at the end without output file
+        results = [None] * (0 if self.sink else len(ftp_files))
+        # Files are only marked as processed when the API returned a result,
+        # the others are retried at the next interval
+        done = []
+        lock = threading.Lock()
+
+        def record(index, result):
+            with lock:
+                if self.sink:
+                    self.sink.write(result)
+                else:
+                    results[index] = result
+                if "results" in result:
+                    done.append(ftp_files[index])
+
+        try:
+            if self.download_workers and ftp_files:
+                self.process_pipelined([info[0] for info in ftp_files], record)
+            else:
+                for index, file_last_modified in enumerate(ftp_files):
+                    ftp_file = file_last_modified[0]
+                    logging.info(ftp_file)
+                    with self.download(ftp_file) as image:
+                        record(index, self.recognize(image, ftp_file))
+        finally:
+            self.seen.add(directory, done)
+
+        if self.sink:
+            self.sink.flush()
         else:
-            print(json.dumps(results, indent=2))
+            with self.output_lock:
+                print(
+                    json.dumps(
+                        [result for result in results if result is not None], indent=2
+                    )
+                )
 
     def get_month_literal(self, month_number):
         month_mapping = {
@@ -246,6 +493,7 @@ class FTPProcessor(FileTransferProcessor):
         super().__init__(**kwargs)
         self.ftp = None
         self.os_linux = None
+        self.mlsd = None
 
     def connect(self):
         self.ftp = FTP(timeout=120)
@@ -254,6 +502,16 @@ class FTPProcessor(FileTransferProcessor):
         logging.info(f"Connected to FTP server at {self.hostname}")
         return self.ftp
 
+    def close(self):
+        self.close_download_connections()
+        if self.ftp is None:
+            return
+        try:
+            self.ftp.quit()
+        except Exception:
+            self.ftp.close()
+        self.ftp = None
+
     def delete_file(self, file):
         try:
             response = self.ftp.delete(file)
@@ -292,13 +550,57 @@ class FTPProcessor(FileTransferProcessor):
         """
         self.ftp.retrbinary("RETR " + file, image.write)
 
+    def supports_mlsd(self):
+        try:
+            return "MLST" in self.ftp.sendcmd("FEAT")
+        except ftplib.all_errors:
+            return False
+
     def list_files(self):
+        """
+        :return: (name, facts) of MLSD when the server supports it, it has
+            exact sizes and times that are cheap to parse. Otherwise the LIST
+            lines split in fields.
+        """
+        if self.mlsd is None:
+            self.mlsd = self.supports_mlsd()
+        if self.mlsd:
+            return list(self.ftp.mlsd(facts=["type", "size", "modify"]))
         file_list = []
         self.ftp.retrlines("LIST", lambda x: file_list.append(x.split(maxsplit=8)))
         return file_list
 
+    @staticmethod
+    def parse_mlsd_time(modify):
+        """
+        YYYYMMDDHHMMSS[.sss] in UTC to local time
+        """
+        utc = datetime(
+            int(modify[0:4]),
+            int(modify[4:6]),
+            int(modify[6:8]),
+            int(modify[8:10]),
+            int(modify[10:12]),
+            int(modify[12:14]),
+            tzinfo=timezone.utc,
+        )
+        return utc.astimezone().replace(tzinfo=None)
+
     @get_files_and_dirs
     def retrieve_files(self, file_list, dirs, nondirs):
+        if self.mlsd:
+            for name, facts in file_list:
+                if facts.get("type") == "dir":
+                    dirs.append(name)
+                elif facts.get("type") == "file":
+                    nondirs.append(
+                        [
+                            name,
+                            self.parse_mlsd_time(facts["modify"]),
+                            int(facts["size"]),
+                        ]
+                    )
+            return
         self.os_linux = self.is_linux_os(file_list)
         for info in file_list:
             name = info[-1]
@@ -308,7 +610,11 @@ class FTPProcessor(FileTransferProcessor):
             else:
                 if self.os_linux:
                     nondirs.append(
-                        [name, self.parse_date(info[-4], info[-3], info[-2])]
+                        [
+                            name,
+                            self.parse_date(info[-4], info[-3], info[-2]),
+                            int(info[4]),
+                        ]
                     )
                 else:
                     file_date = info[0].split("-")
@@ -326,6 +632,7 @@ class FTPProcessor(FileTransferProcessor):
                             self.parse_date(
                                 file_date[0], file_date[1], file_time, linux=False
                             ),
+                            int(info[-2]),
                         ]
                     )
 
@@ -333,12 +640,13 @@ class FTPProcessor(FileTransferProcessor):
 class SFTPProcessor(FileTransferProcessor):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        self.ssh = None
         self.sftp = None
         self.os_linux = True
 
     def connect(self):
         try:
-            ssh = paramiko.SSHClient()
+            ssh = self.ssh = paramiko.SSHClient()
             ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
             if self.ftp_password and not self.pkey:
@@ -375,6 +683,15 @@ class SFTPProcessor(FileTransferProcessor):
 
         return self.sftp
 
+    def close(self):
+        self.close_download_connections()
+        if self.sftp is not None:
+            self.sftp.close()
+            self.sftp = None
+        if self.ssh is not None:
+            self.ssh.close()
+            self.ssh = None
+
     def delete_file(self, file):
         try:
             self.sftp.remove(file)
@@ -406,35 +723,21 @@ class SFTPProcessor(FileTransferProcessor):
         self.sftp.getfo(wd + "/" + file, image)
 
     def list_files(self):
-        file_list = []
-
         try:
-            file_list_attr = self.sftp.listdir_attr()
-
-            for attr in file_list_attr:
-                file_list.append(str(attr).split())
-
-            for info in file_list:
-                # info format: ['-rw-------', '1', '0', '0', '175289', '16', 'Nov', '18:10', 'demo.jpg']
-                # adapting to linux standard: ['-rw-------', '1', '0', '0', '175289', 'Nov', '16', '18:10', 'demo.jpg']
-                tmp_month = info[-3]
-                info[-3] = info[-4]
-                info[-4] = tmp_month
-
+            return self.sftp.listdir_attr()
         except Exception as e:
             print(f"Error listing files: {e}")
-            return
-
-        return file_list
+            return []
 
     @get_files_and_dirs
     def retrieve_files(self, file_list, dirs, nondirs):
-        for info in file_list:
-            name = info[-1]
-            if info[0].startswith("d"):
-                dirs.append(name)
+        for attr in file_list:
+            if stat.S_ISDIR(attr.st_mode):
+                dirs.append(attr.filename)
             else:
-                nondirs.append([name, self.parse_date(info[-4], info[-3], info[-2])])
+                nondirs.append(
+                    [attr.filename, datetime.fromtimestamp(attr.st_mtime), attr.st_size]
+                )
 
 
 def parse_arguments(args_hook=lambda _: _):
@@ -487,6 +790,13 @@ ftp_and_sftp_processor.py -H host -U user1 -P pass -s http://localhost:8080
 
     if not args.api_key:
         raise Exception("api-key parameter is required")
+    if getattr(args, "output_file", None) and args.rotate_size:
+        if args.format == "json":
+            # The JSON array is only complete when the file is closed
+            parser.error("--format json can not be rotated, use --format jsonl.")
+        args.format = args.format or "jsonl"
+    elif hasattr(args, "format"):
+        args.format = args.format or "json"
 
     return args
 
@@ -548,12 +858,32 @@ ftp_and_sftp_processor.py -c sftp -U usr1  -P pass -H 192.168.0.59 -f /tmp/image
     parser.add_argument(
         "--cameras-root", help="Root folder containing dynamic cameras", required=False
     )
-    parser.add_argument("-o", "--output-file", help="Save result to file.")
+    parser.add_argument(
+        "-o",
+        "--output-file",
+        help="Save result to file. JSONL and CSV results are appended to it.",
+    )
     parser.add_argument(
         "--format",
-        help="Format of the result.",
-        default="json",
-        choices="json csv".split(),
+        help="Format of the result. Default: json, or jsonl with --rotate-size. "
+        "A json file is rewritten at each interval, jsonl and csv are appended.",
+        choices="json jsonl csv".split(),
+    )
+    parser.add_argument(
+        "--rotate-size",
+        type=int,
+        help="Start a new output file when it reaches this size in megabytes, "
+        "the full file is renamed with a timestamp.",
+    )
+    parser.add_argument(
+        "--fsync-interval",
+        type=float,
+        help="Sync the output file to the disk at most every interval seconds.",
+    )
+    parser.add_argument(
+        "--compress",
+        choices=["gzip", "zstd"],
+        help="Compress the output file. zstd requires zstandard.",
     )
     parser.add_argument(
         "--mmc",
@@ -566,6 +896,62 @@ ftp_and_sftp_processor.py -c sftp -U usr1  -P pass -H 192.168.0.59 -f /tmp/image
         type=int,
         help="Periodically fetch new images from the server every interval seconds.",
     )
+    parser.add_argument(
+        "--download-workers",
+        type=int,
+        default=0,
+        help="Download with this many connections to the server while the files "
+        "already downloaded are recognized, instead of one file at a time.",
+    )
+    parser.add_argument(
+        "--recognition-workers",
+        type=int,
+        default=4,
+        help="Number of parallel API calls with --download-workers.",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=16,
+        help="Maximum number of downloaded files waiting for recognition with "
+        "--download-workers.",
+    )
+    parser.add_argument(
+        "--spool-size",
+        type=int,
+        default=16,
+        help="Keep downloaded files in memory up to this size in megabytes, "
+        "larger files are written to a temporary file. 0 keeps all files in "
+        "memory.",
+    )
+    parser.add_argument(
+        "--camera-workers",
+        type=int,
+        default=1,
+        help="With --cameras-root, process this many cameras at the same time, "
+        "each with its own connection.",
+    )
+    parser.add_argument(
+        "--camera-batch",
+        type=int,
+        default=100,
+        help="With --camera-workers, process at most this many files of a camera "
+        "before moving to the next camera.",
+    )
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        help="Maximum number of connections to the server, --camera-workers is "
+        "reduced to stay under it.",
+    )
+    parser.add_argument(
+        "--state-db",
+        default=":memory:",
+        help="Remember the files already processed in this SQLite file, so that "
+        "only new or changed files are processed after a restart.",
+    )
+    add_rate_limit_arguments(parser)
+    add_cache_arguments(parser)
 
     def default_port():
         return 21 if parser.parse_args().protocol == "ftp" else 22
@@ -573,7 +959,127 @@ ftp_and_sftp_processor.py -c sftp -U usr1  -P pass -H 192.168.0.59 -f /tmp/image
     parser.set_defaults(port=default_port())
 
 
-def ftp_process(args):
+class CameraTask:
+    """
+    Files of a camera folder waiting to be processed
+    """
+
+    def __init__(self, directory, camera_id, subfolder=False):
+        self.directory = directory
+        self.camera_id = camera_id
+        self.subfolder = subfolder
+        self.files = None
+        self.count = 0
+        self.start = default_timer()
+
+
+def camera_worker(file_processor, tasks, batch_size):
+    """
+    Process a batch of files of the next camera from its own connection, the
+    camera goes back at the end of the queue while it has files left so that
+    a large folder does not delay the other cameras.
+    """
+    processor = file_processor.clone()
+    try:
+        processor.connect()
+    except Exception as e:
+        logging.error(f"Camera connection failed: {e}")
+        processor = None
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        try:
+            if processor is None:
+                continue
+            processor.set_working_directory(task.directory)
+            processor.camera_id = task.camera_id
+            if task.files is None:
+                _, dirs, nondirs = processor.retrieve_files()
+                # Same key as process_files
+                directory = processor.get_working_directory()
+                task.files = processor.seen.new_files(directory, nondirs)
+                logging.info(
+                    "Found %s new file(s) in %s.", len(task.files), task.directory
+                )
+                if not task.subfolder:
+                    # Don't process files any deeper
+                    for folder in dirs:
+                        tasks.put(
+                            CameraTask(f"{task.directory}/{folder}", folder, True)
+                        )
+            batch = task.files[:batch_size]
+            task.files = task.files[batch_size:]
+            if batch:
+                processor.process_files(batch)
+                task.count += len(batch)
+            if task.files:
+                tasks.put(task)
+            elif task.count:
+                logging.info(
+                    "Camera %s: %s file(s) in %.1fs.",
+                    task.directory,
+                    task.count,
+                    default_timer() - task.start,
+                )
+        except Exception as e:
+            logging.error(f"{task.directory}: {e}")
+        finally:
+            tasks.task_done()
+    if processor is not None:
+        processor.close()
+
+
+def process_cameras(file_processor, args, folders):
+    """
+    Process the camera folders with camera_workers connections, limited to
+    max_connections including the download connections of each worker.
+    """
+    per_worker = 1 + args.download_workers
+    workers = args.camera_workers
+    if args.max_connections:
+        # One connection is kept to list the cameras
+        workers = min(workers, max(1, (args.max_connections - 1) // per_worker))
+    logging.info("Processing %s camera(s) with %s worker(s).", len(folders), workers)
+    tasks = queue.Queue()
+    root = args.cameras_root.rstrip("/")
+    for folder in folders:
+        tasks.put(CameraTask(f"{root}/{folder}", folder))
+    threads = [
+        threading.Thread(
+            target=camera_worker,
+            args=(file_processor, tasks, args.camera_batch),
+            name=f"camera-{i}",
+        )
+        for i in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    tasks.join()
+    for _ in threads:
+        tasks.put(None)
+    for thread in threads:
+        thread.join()
+
+
+def open_sink(args):
+    """
+    Output file shared by all the folders and cameras of the run. A JSON file
+    is written to a temporary file by each run, see json_cycle.
+    """
+    if not args.output_file or args.format == "json":
+        return None
+    return ResultWriter(
+        args.output_file,
+        args.format,
+        append=True,
+        fsync_interval=args.fsync_interval,
+        max_bytes=args.rotate_size and args.rotate_size * 1024 * 1024,
+        compression=args.compress,
+    )
+
+
+def ftp_process(args, seen, sink=None):
     args_dict = vars(args)
 
     if args.protocol == "ftp":
@@ -588,36 +1094,87 @@ def ftp_process(args):
         print(f"{attr}: {value}")
     """
 
+    file_processor.seen = seen
+    file_processor.sink = sink
     file_processor.connect()
 
-    if args.cameras_root:
-        file_processor.set_working_directory(args.cameras_root)
-        file_list, dirs, nondirs = file_processor.retrieve_files()
-        for folder in dirs:
-            logging.info(
-                f"Processing Dynamic Camera : {file_processor.get_working_directory()}"
-            )
-            args.folder = os.path.join(args.cameras_root, folder)
-            # The camera id is the folder name
-            args.camera_id = folder
+    try:
+        if args.cameras_root and args.camera_workers > 1:
+            file_processor.set_working_directory(args.cameras_root)
+            file_list, dirs, nondirs = file_processor.retrieve_files()
+            process_cameras(file_processor, args, dirs)
+        elif args.cameras_root:
+            file_processor.set_working_directory(args.cameras_root)
+            file_list, dirs, nondirs = file_processor.retrieve_files()
+            for folder in dirs:
+                logging.info(
+                    f"Processing Dynamic Camera : {file_processor.get_working_directory()}"
+                )
+                args.folder = os.path.join(args.cameras_root, folder)
+                # The camera id is the folder name
+                args.camera_id = folder
 
+                file_processor.processing_single_camera(args)
+        else:
             file_processor.processing_single_camera(args)
-    else:
-        file_processor.processing_single_camera(args)
+    finally:
+        file_processor.close()
+
+
+def json_cycle(args, seen):
+    """
+    Process the server once and replace the JSON output file with the results,
+    the file is always a complete JSON array. A run without results keeps the
+    previous file.
+    """
+    sink = ResultWriter(
+        f"{args.output_file}.tmp",
+        "json",
+        fsync_interval=args.fsync_interval,
+        compression=args.compress,
+    )
+    try:
+        ftp_process(args, seen, sink)
+    finally:
+        sink.close()
+        if sink.count:
+            os.replace(sink.path, args.output_file)
+        else:
+            sink.path.unlink()
 
 
 def main():
     args = parse_arguments(custom_args)
-
-    if args.interval and args.interval > 0:
-        while True:
-            try:
-                ftp_process(args)
-            except Exception as e:
-                print(f"ERROR: {e}")
-            time.sleep(args.interval)
+    configure_client(
+        pool_size=(args.recognition_workers if args.download_workers else 1)
+        * max(1, args.camera_workers),
+        limiter=make_rate_limiter(args),
+    )
+    cache = open_cache(args)
+    seen = SeenFiles(args.state_db)
+    sink = open_sink(args)
+    if args.output_file and args.format == "json":
+        process = json_cycle
     else:
-        ftp_process(args)
+        process = partial(ftp_process, sink=sink)
+
+    try:
+        if args.interval and args.interval > 0:
+            while True:
+                try:
+                    process(args, seen)
+                except Exception as e:
+                    print(f"ERROR: {e}")
+                if cache:
+                    logging.info(cache.stats())
+                time.sleep(args.interval)
+        else:
+            process(args, seen)
+    finally:
+        if sink:
+            sink.close()
+        seen.close()
+        close_cache(cache)
 
 
 if __name__ == "__main__":
@@ -1,16 +1,44 @@
-import io
 import json
 import math
+import queue
 import re
-from itertools import combinations
+import sys
+import threading
+import time
+from functools import partial
 from pathlib import Path
 
-from PIL import Image, ImageFilter
-
-from plate_recognition import draw_bb, parse_arguments, recognition_api
-
-
-def blur(im, blur_amount, api_res, ignore_no_bb=False, ignore_list=None):
+from PIL import Image, ImageDraw, ImageFilter
+
+from plate_recognition import (
+    ImageContext,
+    Journal,
+    ResultWriter,
+    TileEncoder,
+    add_cache_arguments,
+    add_rate_limit_arguments,
+    add_tile_encoder_arguments,
+    close_cache,
+    configure_client,
+    draw_bb,
+    make_rate_limiter,
+    merge_results,
+    open_cache,
+    open_journal,
+    parse_arguments,
+    post_processing,
+    recognition_api,
+    recognize_tiles,
+)
+
+
+def blur_boxes(api_res, ignore_no_bb=False, ignore_list=None):
+    """
+    Boxes of the plates to blur
+
+    :return: list of (xmin, ymin, xmax, ymax)
+    """
+    boxes = []
     for res in api_res.get("results", []):
         if ignore_no_bb and res["vehicle"]["score"] == 0.0:
             continue
@@ -25,86 +53,106 @@ def blur(im, blur_amount, api_res, ignore_no_bb=False, ignore_list=None):
                 continue
 
         b = res["box"]
-        width, height = b["xmax"] - b["xmin"], b["ymax"] - b["ymin"]
-        crop_box = (b["xmin"], b["ymin"], b["xmax"], b["ymax"])
-        ic = im.crop(crop_box)
-
-        # Increase amount of blur with size of bounding box
-        blur_image = ic.filter(
-            ImageFilter.GaussianBlur(
-                radius=math.sqrt(width * height) * 0.3 * blur_amount / 10
+        boxes.append((b["xmin"], b["ymin"], b["xmax"], b["ymax"]))
+    return boxes
+
+
+def gaussian_blur(im, radius, backend="pil"):
+    if backend == "opencv":
+        try:
+            import cv2
+            import numpy
+        except ImportError:
+            print(
+                "A dependency is missing. Please install: "
+                "https://pypi.org/project/opencv-python-headless/"
             )
-        )
-        im.paste(blur_image, crop_box)
-    return im
-
-
-def bb_iou(a, b):
-    # determine the (x, y)-coordinates of the intersection rectangle
-    x_a = max(a["xmin"], b["xmin"])
-    y_a = max(a["ymin"], b["ymin"])
-    x_b = min(a["xmax"], b["xmax"])
-    y_b = min(a["ymax"], b["ymax"])
-
-    # compute the area of both the prediction and ground-truth
-    # rectangles
-    area_a = (a["xmax"] - a["xmin"]) * (a["ymax"] - a["ymin"])
-    area_b = (b["xmax"] - b["xmin"]) * (b["ymax"] - b["ymin"])
-
-    # compute the area of intersection rectangle
-    area_inter = max(0, x_b - x_a) * max(0, y_b - y_a)
-    return area_inter / float(max(area_a + area_b - area_inter, 1))
-
+            exit(1)
+        pixels = numpy.asarray(im)
+        if hasattr(cv2, "stackBlur"):
+            # Close to a Gaussian blur, the time does not depend on the radius
+            size = 2 * math.ceil(2 * radius) + 1
+            return Image.fromarray(cv2.stackBlur(pixels, (size, size)))
+        return Image.fromarray(cv2.GaussianBlur(pixels, (0, 0), max(radius, 0.1)))
+    return im.filter(ImageFilter.GaussianBlur(radius=radius))
+
+
+def group_boxes(boxes):
+    """
+    Group the boxes that overlap each other
+
+    :return: list of (region containing the group, boxes of the group)
+    """
+    groups = []
+    for box in boxes:
+        region, members = box, [box]
+        merged = True
+        while merged:
+            merged = False
+            for other_region, other_members in groups:
+                if (
+                    other_region[0] < region[2]
+                    and region[0] < other_region[2]
+                    and other_region[1] < region[3]
+                    and region[1] < other_region[3]
+                ):
+                    groups.remove((other_region, other_members))
+                    region = (
+                        min(region[0], other_region[0]),
+                        min(region[1], other_region[1]),
+                        max(region[2], other_region[2]),
+                        max(region[3], other_region[3]),
+                    )
+                    members = other_members + members
+                    merged = True
+                    break
+        groups.append((region, members))
+    return groups
+
+
+def area(box):
+    return (box[2] - box[0]) * (box[3] - box[1])
+
+
+def blur(im, blur_amount, api_res, ignore_no_bb=False, ignore_list=None, backend="pil"):
+    """
+    Blur the plates through a mask of their boxes. Each group of overlapping
+    plates is blurred once, at the blur amount of its largest plate. When the
+    plates cover most of the region containing them all, that region is
+    blurred once instead of each group.
+    """
+    boxes = blur_boxes(api_res, ignore_no_bb, ignore_list)
+    if not boxes:
+        return im
+    groups = group_boxes(boxes)
+    union = (
+        min(b[0] for b in boxes),
+        min(b[1] for b in boxes),
+        max(b[2] for b in boxes),
+        max(b[3] for b in boxes),
+    )
+    if len(groups) > 1 and area(union) <= 2 * sum(area(r) for r, _ in groups):
+        groups = [(union, boxes)]
 
-def clean_objs(objects, threshold=0.1):
-    # Only keep the ones with best score or no overlap
-    for o1, o2 in combinations(objects, 2):
-        if (
-            "remove" in o1
-            or "remove" in o2
-            or bb_iou(o1["box"], o2["box"]) <= threshold
-        ):
-            continue
-        if o1["score"] > o2["score"]:
-            o2["remove"] = True
-        else:
-            o1["remove"] = True
-    return [x for x in objects if "remove" not in x]
-
-
-def merge_results(images):
-    result = dict(results=[])
-    for data in images:
-        for item in data["prediction"]["results"]:
-            result["results"].append(item)
-            for b in [item["box"], item["vehicle"].get("box", {})]:
-                b["ymin"] += data["y"]
-                b["xmin"] += data["x"]
-                b["ymax"] += data["y"]
-                b["xmax"] += data["x"]
-    result["results"] = clean_objs(result["results"])
-    return result
-
-
-def inside(a, b):
-    return (
-        a["xmin"] > b["xmin"]
-        and a["ymin"] > b["ymin"]
-        and a["xmax"] < b["xmax"]
-        and a["ymax"] < b["ymax"]
-    )
-
-
-def post_processing(results):
-    new_list = []
-    for item in results["results"]:
-        if item["score"] < 0.2 and any(
-            [inside(x["box"], item["box"]) for x in results["results"] if x != item]
-        ):
+    for region, members in groups:
+        # Increase amount of blur with size of bounding box
+        radius = max(math.sqrt(area(b)) * 0.3 * blur_amount / 10 for b in members)
+        xmin, ymin = max(0, region[0]), max(0, region[1])
+        xmax, ymax = min(im.width, region[2]), min(im.height, region[3])
+        if xmin >= xmax or ymin >= ymax:
             continue
-        new_list.append(item)
-    results["results"] = new_list
-    return results
+        mask = None
+        if len(members) > 1:
+            mask = Image.new("L", (xmax - xmin, ymax - ymin), 0)
+            draw = ImageDraw.Draw(mask)
+            for b in members:
+                draw.rectangle(
+                    (b[0] - xmin, b[1] - ymin, b[2] - xmin - 1, b[3] - ymin - 1),
+                    fill=255,
+                )
+        crop_box = (xmin, ymin, xmax, ymax)
+        im.paste(gaussian_blur(im.crop(crop_box), radius, backend), crop_box, mask)
+    return im
 
 
 def process_image(path, args, i):
@@ -115,10 +163,9 @@ def process_image(path, args, i):
     )
 
     # Predictions
-    source_im = Image.open(path)
-    if source_im.mode != "RGB":
-        source_im = source_im.convert("RGB")
-    images = [((0, 0), source_im)]  # Entire image
+    context = ImageContext(path)
+    source_im = context.image
+    images = [((0, 0), context.original or source_im)]  # Entire image
     # Top left and top right crops
     if args.split_image:
         y = 0
@@ -128,15 +175,19 @@ def process_image(path, args, i):
             images.append(((x, y), source_im.crop((x, y, x + width, y + height))))
 
     # Inference
-    results = []
-    for (x, y), im in images:
-        im_bytes = io.BytesIO()
-        im.save(im_bytes, "JPEG", quality=95)
-        im_bytes.seek(0)
-        im_results = recognition_api(
-            im_bytes, args.regions, args.api_key, args.sdk_url, config=config
-        )
-        results.append(dict(prediction=im_results, x=x, y=y))
+    results = recognize_tiles(
+        images,
+        partial(
+            recognition_api,
+            regions=args.regions,
+            api_key=args.api_key,
+            sdk_url=args.sdk_url,
+            config=config,
+            exit_on_error=not args.watch,
+        ),
+        len(images),
+        TileEncoder.from_args(args),
+    )
     results = post_processing(merge_results(results))
     results["filename"] = Path(path).name
 
@@ -161,6 +212,7 @@ def process_image(path, args, i):
             results,
             ignore_no_bb=args.ignore_no_bb,
             ignore_list=args.ignore_regexp,
+            backend=args.blur_backend,
         )
 
         if args.show_boxes:
@@ -173,6 +225,117 @@ def process_image(path, args, i):
     return results
 
 
+def wait_for_file(path, interval=0.5, timeout=60):
+    """
+    Wait until a file that is being written has a stable size
+
+    :return: False if the file is removed or still changing after timeout
+    """
+    size = -1
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            current = path.stat().st_size
+        except FileNotFoundError:
+            return False
+        if current and current == size:
+            return True
+        size = current
+        time.sleep(interval)
+    return False
+
+
+class NewImageHandler:
+    """
+    watchdog event handler queuing the images created in or moved to a
+    directory. Blurred images written by the workers are ignored.
+    """
+
+    suffixes = {".jpg", ".jpeg", ".png", ".webp"}
+
+    def __init__(self, images):
+        self.images = images
+
+    def dispatch(self, event):
+        if event.is_directory or event.event_type not in ("created", "moved"):
+            return
+        # Files are often renamed once they are complete
+        path = Path(event.dest_path if event.event_type == "moved" else event.src_path)
+        if path.suffix.lower() in self.suffixes and not path.stem.endswith("_blurred"):
+            self.images.put(path)
+
+
+def redact_worker(images, args, record):
+    while True:
+        path = images.get()
+        if path is None:
+            break
+        try:
+            if wait_for_file(path):
+                record(process_image(path, args, 0))
+                print(f"{path} redacted", file=sys.stderr)
+            else:
+                print(f"{path} skipped, it is missing or incomplete", file=sys.stderr)
+        except Exception as e:
+            print(f"{path}: {e}", file=sys.stderr)
+
+
+def watch(args):
+    """
+    Redact each new image of args.watch as it lands, with args.workers threads.
+    The blurred image is saved next to it and the result is written as one
+    JSON line per image.
+    """
+    try:
+        from watchdog.observers import Observer
+    except ImportError:
+        print(
+            "A dependency is missing. Please install: "
+            "https://pythonhosted.org/watchdog/installation.html"
+        )
+        exit(1)
+
+    args.save_blurred = True
+    images = queue.Queue(256)
+    lock = threading.Lock()
+    writer = None
+    if args.output_file:
+        writer = ResultWriter(args.output_file, "jsonl", append=True)
+
+    def record(result):
+        with lock:
+            if writer:
+                writer.write(result)
+                writer.flush()
+            else:
+                print(json.dumps(result), flush=True)
+
+    observer = Observer()
+    observer.schedule(NewImageHandler(images), str(args.watch), recursive=True)
+    threads = [
+        threading.Thread(target=redact_worker, args=(images, args, record), daemon=True)
+        for _ in range(max(1, args.workers))
+    ]
+    for thread in threads:
+        thread.start()
+    observer.start()
+    print(f"Monitoring {args.watch}.", file=sys.stderr)
+    try:
+        while observer.is_alive():
+            observer.join(1)
+    except KeyboardInterrupt:
+        pass
+    print("Closing...", file=sys.stderr)
+    observer.stop()
+    observer.join()
+    for _ in threads:
+        images.put(None)
+    for thread in threads:
+        thread.join()
+    if writer:
+        writer.close()
+
+
 def custom_args(parser):
     parser.epilog += "To analyse the image for redaction: python number_plate_redaction.py  --api-key MY_API_KEY --split-image /tmp/car.jpg"
     parser.add_argument(
@@ -180,6 +343,7 @@ def custom_args(parser):
         action="store_true",
         help="Do extra lookups on parts of the image. Useful on high resolution images.",
     )
+    add_tile_encoder_arguments(parser)
     parser.add_argument(
         "--show-boxes", action="store_true", help="Display the resulting blurred image."
     )
@@ -188,6 +352,12 @@ def custom_args(parser):
         action="store_true",
         help="Blur license plates and save image in filename_blurred.jpg.",
     )
+    parser.add_argument(
+        "--blur-backend",
+        default="pil",
+        choices=["pil", "opencv"],
+        help="Library used to blur the plates. OpenCV requires opencv-python-headless.",
+    )
     parser.add_argument(
         "--ignore-regexp",
         action="append",
@@ -210,14 +380,76 @@ def custom_args(parser):
         default=0.5,
         help="Keep all plates if the characters reading score is above this threshold. Between 0 and 1.",
     )
+    add_rate_limit_arguments(parser)
+    add_cache_arguments(parser)
+    parser.add_argument(
+        "--watch",
+        type=Path,
+        help="Redact the new images of this directory as they arrive, "
+        "instead of the files given as arguments.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of images redacted at the same time in --watch mode.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-file",
+        type=Path,
+        help="Append the result of each image to this JSONL file in --watch mode. "
+        "Default: stdout.",
+    )
+    parser.add_argument(
+        "--journal",
+        type=Path,
+        help="Record processed images and their results in this file. Defaults to number_plate_redaction.journal when resuming.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip images already recorded in the journal and reuse their results.",
+    )
 
 
 def main():
     args = parse_arguments(custom_args)
+    if args.watch:
+        if not args.watch.is_dir():
+            print(f"{args.watch} is not a directory")
+            return
+        configure_client(
+            pool_size=max(1, args.workers) * (3 if args.split_image else 1),
+            limiter=make_rate_limiter(args),
+        )
+        cache = open_cache(args)
+        try:
+            watch(args)
+        finally:
+            close_cache(cache)
+        return
+    configure_client(limiter=make_rate_limiter(args))
     result = []
-    for i, path in enumerate(args.files):
-        if Path(path).is_file():
-            result.append(process_image(path, args, i))
+    journal = open_journal(args, "number_plate_redaction.journal")
+    cache = open_cache(args)
+    try:
+        for i, path in enumerate(args.files):
+            if not Path(path).is_file():
+                continue
+            key = Journal.key(path) if journal else None
+            im_result = journal.get(key) if journal else None
+            if im_result is None:
+                im_result = process_image(path, args, i)
+                if journal:
+                    journal.add(key, im_result)
+            else:
+                print(f"{path} resumed", file=sys.stderr)
+            result.append(im_result)
+    finally:
+        if journal:
+            journal.close()
+        close_cache(cache)
     if 0:
         for im_result in result:
             for i, x in enumerate(im_result["results"]):
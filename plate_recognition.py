@@ -2,26 +2,42 @@
 
 import argparse
 import csv
+import gzip
+import hashlib
 import io
 import json
 import math
+import os
+import random
+import sqlite3
 import sys
+import threading
 import time
-from collections import OrderedDict
-from itertools import combinations
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from functools import lru_cache, partial
 from pathlib import Path
+from timeit import default_timer
 
 import requests
 from PIL import Image, ImageDraw, ImageFont
+from requests.adapters import HTTPAdapter
+
+from box_utils import suppress_contained, suppress_overlaps
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore[assignment]
 
 if sys.version_info.major == 3 and sys.version_info.minor >= 10:
     from collections.abc import MutableMapping
 else:
-    # ruff: noqa
-    from collections import MutableMapping  # type: ignore[attr-defined]
+    from collections import MutableMapping  # type: ignore[attr-defined]  # noqa: UP035
 
 
-def parse_arguments(args_hook=lambda _: _):
+def parse_arguments(args_hook=lambda _: _, argv=None):
     parser = argparse.ArgumentParser(
         description="Read license plates from images and output the result as JSON or CSV.",
         epilog="""Examples:
@@ -50,19 +66,222 @@ Specify Camera ID and/or two Regions:
     parser.add_argument(
         "--camera-id", help="Name of the source camera.", required=False
     )
-    parser.add_argument("files", nargs="+", type=Path, help="Path to vehicle images")
+    parser.add_argument("files", nargs="*", type=Path, help="Path to vehicle images")
     args_hook(parser)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if not args.files and not getattr(args, "watch", None):
+        parser.error("the following arguments are required: files")
+    if getattr(args, "split_adaptive", False) and not args.split_image:
+        parser.error("--split-adaptive requires --split-image")
     if not args.sdk_url and not args.api_key:
         raise Exception("api-key is required")
     return args
 
 
-_session = None
+def retry_delay(attempt, retry_after=None, backoff=0.5, max_backoff=30.0):
+    """
+    Seconds to wait before retrying a call
+
+    :param attempt: number of the failed attempt, starting at 0
+    :param retry_after: value of the Retry-After header, in seconds or an HTTP date
+    """
+    if retry_after:
+        try:
+            return min(float(retry_after), max_backoff)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+                return min(max(0.0, retry_at.timestamp() - time.time()), max_backoff)
+            except (TypeError, ValueError):
+                pass
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(max_backoff, backoff * 2**attempt))
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the number of calls per second.
+
+    Up to burst calls can be made at once, then calls are spaced to match the
+    rate. It is thread safe: each call reserves the next free slot.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Reserve a call
+
+        :return: seconds to wait before making the call
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
 
+    def acquire(self):
+        time.sleep(self.reserve())
 
-def recognition_api(
-    fp,
+
+class SharedRateLimiter(RateLimiter):
+    """
+    RateLimiter whose bucket is stored in a lock file so that all the processes
+    using the same file on this machine share the same limit.
+    """
+
+    def __init__(self, rate, burst=None, path="platerec-rate.lock"):
+        if fcntl is None:
+            raise Exception("A shared rate limit is not supported on this platform.")
+        super().__init__(rate, burst)
+        self.path = Path(path)
+
+    def reserve(self):
+        with self._lock, open(self.path, "a+") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)  # Released when the file is closed
+            fp.seek(0)
+            now = time.time()
+            try:
+                tokens, updated = json.loads(fp.read())
+            except ValueError:
+                tokens, updated = self.burst, now
+            tokens = min(self.burst, tokens + max(0.0, now - updated) * self.rate) - 1
+            fp.seek(0)
+            fp.truncate()
+            fp.write(json.dumps([tokens, now]))
+            fp.flush()
+        return max(0.0, -tokens / self.rate)
+
+
+def make_rate_limiter(args):
+    if not getattr(args, "rate", None):
+        return None
+    if args.rate_lock_file:
+        return SharedRateLimiter(args.rate, args.burst, args.rate_lock_file)
+    return RateLimiter(args.rate, args.burst)
+
+
+def add_rate_limit_arguments(parser):
+    parser.add_argument(
+        "--rate",
+        type=float,
+        help="Maximum number of API calls per second, for example your plan limit.",
+    )
+    parser.add_argument(
+        "--burst",
+        type=int,
+        help="Number of API calls that can be made at once. Defaults to the rate.",
+    )
+    parser.add_argument(
+        "--rate-lock-file",
+        type=Path,
+        help="Share the rate limit with other processes using the same file.",
+    )
+
+
+class ApiClient:
+    """
+    HTTP client shared by all calls to the Plate Recognizer APIs.
+
+    Connections are kept alive in a pool sized for the number of concurrent
+    calls. Calls that hit the rate limit (429), a temporary server error or a
+    connection error are retried with an exponential backoff and jitter. A call
+    that times out while waiting for the response is not retried. The
+    Retry-After header is used when the server sends it. An optional
+    RateLimiter spaces the calls so that the rate limit is not reached.
+    """
+
+    RETRY_STATUSES = (429, 502, 503, 504)
+
+    def __init__(
+        self,
+        pool_size=10,
+        retries=5,
+        backoff=0.5,
+        max_backoff=30.0,
+        timeout=60,
+        limiter=None,
+    ):
+        self.limiter = limiter
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def delay(self, attempt, response=None):
+        retry_after = None
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+        return retry_delay(attempt, retry_after, self.backoff, self.max_backoff)
+
+    @staticmethod
+    def _rewind(files):
+        for value in (files or {}).values():
+            fp = value[1] if isinstance(value, tuple) else value
+            if hasattr(fp, "seek"):
+                fp.seek(0)
+
+    def post(self, url, files=None, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        for attempt in range(self.retries + 1):
+            self._rewind(files)
+            if self.limiter:
+                self.limiter.acquire()
+            try:
+                response = self.session.post(url, files=files, **kwargs)
+            except (requests.ConnectionError, requests.ConnectTimeout):
+                # Not a read timeout, the server may have accepted the call
+                # and it would be charged again
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.delay(attempt))
+                continue
+            if response.status_code not in self.RETRY_STATUSES or (
+                attempt == self.retries
+            ):
+                return response
+            time.sleep(self.delay(attempt, response))
+
+
+_client = None
+_cache = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Client shared by all API calls so connections are kept alive and reused
+    """
+    global _client
+    with _client_lock:
+        if not _client:
+            _client = ApiClient()
+    return _client
+
+
+def configure_client(**kwargs):
+    """
+    Replace the shared client, for example to size its pool for the concurrency
+    """
+    global _client
+    with _client_lock:
+        _client = ApiClient(**kwargs)
+    return _client
+
+
+def build_request(
     regions=None,
     api_key=None,
     sdk_url=None,
@@ -70,56 +289,77 @@ def recognition_api(
     camera_id=None,
     timestamp=None,
     mmc=None,
-    exit_on_error=True,
 ):
-    if regions is None:
-        regions = []
-    if config is None:
-        config = {}
-    global _session
-    data = dict(regions=regions, config=json.dumps(config))
+    """
+    :return: (url, name of the upload field, form data, headers)
+    """
+    if "container-api" in (sdk_url or ""):
+        return (
+            "https://container-api.parkpow.com/api/v1/predict/",
+            "image",
+            None,
+            {"Authorization": "Token " + api_key},
+        )
+    data = dict(regions=regions or [], config=json.dumps(config or {}))
     if camera_id:
         data["camera_id"] = camera_id
     if mmc:
         data["mmc"] = mmc
     if timestamp:
         data["timestamp"] = timestamp
-    response = None
     if sdk_url:
-        fp.seek(0)
-        if "container-api" in sdk_url:
-            response = requests.post(
-                "https://container-api.parkpow.com/api/v1/predict/",
-                files=dict(image=fp),
-                headers={"Authorization": "Token " + api_key},
-            )
-        else:
-            response = requests.post(
-                sdk_url + "/v1/plate-reader/", files=dict(upload=fp), data=data
-            )
-    else:
-        if not _session:
-            _session = requests.Session()
-            _session.headers.update({"Authorization": "Token " + api_key})
-        for _ in range(3):
-            fp.seek(0)
-            response = _session.post(
-                "https://api.platerecognizer.com/v1/plate-reader/",
-                files=dict(upload=fp),
-                data=data,
-            )
-            if response.status_code == 429:  # Max calls per second reached
-                time.sleep(1)
-            else:
-                break
+        return sdk_url + "/v1/plate-reader/", "upload", data, None
+    return (
+        "https://api.platerecognizer.com/v1/plate-reader/",
+        "upload",
+        data,
+        {"Authorization": "Token " + api_key},
+    )
+
 
-    if response is None:
-        return {}
+def recognition_api(
+    fp,
+    regions=None,
+    api_key=None,
+    sdk_url=None,
+    config=None,
+    camera_id=None,
+    timestamp=None,
+    mmc=None,
+    exit_on_error=True,
+    client=None,
+    cache=None,
+    filename=None,
+):
+    """
+    :param filename: name of the upload, by default the name of fp. Use it
+        for in-memory files.
+    """
+    url, field, data, headers = build_request(
+        regions, api_key, sdk_url, config, camera_id, timestamp, mmc
+    )
+    cache = cache or _cache
+    if cache:
+        key = cache.key(fp, regions, config, camera_id, timestamp, mmc, url)
+        result = cache.get(key)
+        if result is not None:
+            name = filename or getattr(fp, "name", None)
+            if isinstance(name, str) and "filename" in result:
+                result["filename"] = os.path.basename(name)
+            return result
+    upload = (filename, fp) if filename else fp
+    response = (client or get_client()).post(
+        url, files={field: upload}, data=data, headers=headers
+    )
     if response.status_code < 200 or response.status_code > 300:
         print(response.text)
         if exit_on_error:
             exit(1)
-    return response.json(object_pairs_hook=OrderedDict)
+        return response.json(object_pairs_hook=OrderedDict)
+    result = response.json(object_pairs_hook=OrderedDict)
+    if cache:
+        cache.put(key, result)
+    return result
 
 
 def flatten_dict(d, parent_key="", sep="_"):
@@ -154,10 +394,11 @@ def flatten(result):
     return flattened_data
 
 
-def save_cropped(api_res, path, args):
+def save_cropped(api_res, path, args, image=None):
     dest = args.crop_lp or args.crop_vehicle
     dest.mkdir(exist_ok=True, parents=True)
-    image = Image.open(path).convert("RGB")
+    if image is None:
+        image = Image.open(path).convert("RGB")
     for i, result in enumerate(api_res.get("results", []), 1):
         if args.crop_lp and result["plate"]:
             box = result["box"]
@@ -280,40 +521,450 @@ def transform_result(input_data):
     return output
 
 
-def save_results(results, args):
+# Declared CSV schema. Keeping it fixed lets rows be written as soon as each
+# result is available instead of sniffing the columns from the first results.
+CSV_FIELDNAMES = [
+    "filename",
+    "timestamp",
+    "camera_id",
+    "version",
+    "image_width",
+    "image_height",
+    "processing_time",
+    "box_xmin",
+    "box_ymin",
+    "box_xmax",
+    "box_ymax",
+    "plate",
+    "region_code",
+    "region_score",
+    "score",
+    "candidates",
+    "dscore",
+    "vehicle_score",
+    "vehicle_type",
+    "vehicle_box_xmin",
+    "vehicle_box_ymin",
+    "vehicle_box_xmax",
+    "vehicle_box_ymax",
+    "model_make",
+    "color",
+    "orientation",
+    "direction",
+    "direction_score",
+]
+
+
+class ResultWriter:
+    """
+    Incrementally write results to a JSON, JSONL or CSV file.
+
+    Each result is written as soon as it is passed to write() and the file is
+    flushed every flush_interval seconds, so memory use does not grow with the
+    number of images and an interrupted run keeps what was already written.
+    With append, JSONL and CSV results are added to an existing file.
+
+    Writes are serialized so the writer can be shared by threads. With
+    fsync_interval, flushed data is also synced to the disk at most every
+    fsync_interval seconds. With max_bytes, a full file is renamed with a
+    timestamp and a new one is started, the size of compressed files is only
+    known when they are flushed. compression is gzip or zstd.
+    """
+
+    def __init__(
+        self,
+        path,
+        output_format="json",
+        vehicle_mode=False,
+        flush_interval=1.0,
+        append=False,
+        fsync_interval=None,
+        max_bytes=None,
+        compression=None,
+    ):
+        self.path = Path(path)
+        self.output_format = output_format
+        self.vehicle_mode = vehicle_mode
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.count = 0
+        self._last_flush = self._last_fsync = time.monotonic()
+        self._lock = threading.RLock()
+        if append and output_format == "json":
+            raise ValueError("JSON results can not be appended, use jsonl or csv.")
+        self._open(append)
+
+    def _open(self, append):
+        mode = "ab" if append else "wb"
+        self._raw = open(self.path, mode)
+        if self.compression == "gzip":
+            binary = gzip.GzipFile(fileobj=self._raw, mode=mode)
+        elif self.compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                print(
+                    "A dependency is missing. Please install: "
+                    "https://pypi.org/project/zstandard/"
+                )
+                exit(1)
+            # Appended frames are read as one stream
+            binary = zstandard.ZstdCompressor().stream_writer(self._raw, closefd=False)
+        else:
+            binary = self._raw
+        self._fp = io.TextIOWrapper(
+            binary, newline="" if self.output_format == "csv" else None
+        )
+        self._file_count = 0
+        self._csv = None
+        if self.output_format == "csv":
+            self._csv = csv.DictWriter(
+                self._fp, fieldnames=CSV_FIELDNAMES, extrasaction="ignore"
+            )
+            if not self._raw.tell():
+                self._csv.writeheader()
+        elif self.output_format == "json":
+            self._fp.write("[")
+
+    def _close_file(self):
+        if self.output_format == "json":
+            self._fp.write("]")
+        self._fp.close()
+        self._raw.close()
+
+    def rotate(self):
+        """
+        Rename the current file with a timestamp and start a new one
+        """
+        with self._lock:
+            self._close_file()
+            name = self.path.name.split(".", 1)
+            stamp = time.strftime("%Y%m%d-%H%M%S")
+            suffix = "." + name[1] if len(name) > 1 else ""
+            target = self.path.with_name(f"{name[0]}-{stamp}{suffix}")
+            index = 1
+            while target.exists():
+                target = self.path.with_name(f"{name[0]}-{stamp}-{index}{suffix}")
+                index += 1
+            self.path.rename(target)
+            self._open(False)
+
+    def write(self, result):
+        with self._lock:
+            if self.output_format == "csv":
+                if "results" not in result:
+                    # API error, there is nothing to flatten
+                    print(
+                        f"Skipping result without plates: {json.dumps(result)}",
+                        file=sys.stderr,
+                    )
+                    return
+                data = transform_result(result) if self.vehicle_mode else result
+                for row in flatten(data.copy()):
+                    self._csv.writerow(row)
+            elif self.output_format == "json":
+                if self._file_count:
+                    self._fp.write(", ")
+                json.dump(result, self._fp)
+            else:
+                self._fp.write(json.dumps(result) + "\n")
+            self.count += 1
+            self._file_count += 1
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+            if self.max_bytes and self._raw.tell() >= self.max_bytes:
+                self.rotate()
+
+    def flush(self):
+        with self._lock:
+            self._fp.flush()
+            now = self._last_flush = time.monotonic()
+            if self.fsync_interval is not None and (
+                now - self._last_fsync >= self.fsync_interval
+            ):
+                self._raw.flush()
+                os.fsync(self._raw.fileno())
+                self._last_fsync = now
+
+    def close(self):
+        with self._lock:
+            if self._fp.closed:
+                return
+            self._close_file()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_result_writer(args):
     path = args.output_file
     if not Path(path).parent.exists():
-        print("%s does not exist" % path)
-        return
+        print(f"{path} does not exist")
+        return None
+    return ResultWriter(
+        path,
+        args.format,
+        vehicle_mode=is_detection_mode_vehicle(getattr(args, "engine_config", None)),
+    )
+
+
+def save_results(results, args):
     if not results:
         return
-    if args.format == "json":
-        with open(path, "w") as fp:
-            json.dump(results, fp)
-    elif args.format == "csv":
-        fieldnames = []
-        for result in results[:10]:
-            data = (
-                transform_result(result)
-                if is_detection_mode_vehicle(args.engine_config)
-                else result
+    writer = open_result_writer(args)
+    if writer is None:
+        return
+    with writer:
+        for result in results:
+            writer.write(result)
+
+
+class Journal:
+    """
+    Append-only record of processed images, used to resume interrupted runs.
+
+    Each line holds an image key (path, size and modification time) and the
+    result for that image. Only the offsets of the lines are kept in memory.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = Path(path)
+        self._offsets = {}
+        self._lock = threading.Lock()
+        if resume and self.path.exists():
+            self._load()
+            self._fp = open(self.path, "ab")
+            if self._fp.tell() and not self._ends_with_newline():
+                self._fp.write(b"\n")  # Previous run stopped mid-line
+        else:
+            self._fp = open(self.path, "wb")
+        self._reader = open(self.path, "rb")
+
+    @staticmethod
+    def key(path):
+        stat = Path(path).stat()
+        return f"{Path(path).resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    def _ends_with_newline(self):
+        with open(self.path, "rb") as fp:
+            fp.seek(-1, io.SEEK_END)
+            return fp.read(1) == b"\n"
+
+    def _load(self):
+        with open(self.path, "rb") as fp:
+            offset = 0
+            for line in fp:
+                if line.endswith(b"\n") and b"\t" in line:
+                    key = json.loads(line.split(b"\t", 1)[0])
+                    self._offsets[key] = offset
+                offset += len(line)
+
+    @property
+    def completed(self):
+        return len(self._offsets)
+
+    def get(self, key):
+        offset = self._offsets.get(key)
+        if offset is None:
+            return None
+        with self._lock:
+            self._reader.seek(offset)
+            line = self._reader.readline()
+        return json.loads(line.split(b"\t", 1)[1], object_pairs_hook=OrderedDict)
+
+    def add(self, key, result):
+        line = f"{json.dumps(key)}\t{json.dumps(result)}\n".encode()
+        with self._lock:
+            self._offsets[key] = self._fp.tell()
+            self._fp.write(line)
+            self._fp.flush()
+
+    def close(self):
+        self._fp.close()
+        self._reader.close()
+
+
+class ResultCache:
+    """
+    SQLite cache of API results keyed by the image content and the request
+    parameters. It is used to avoid paying again for images that were already
+    sent, like duplicate uploads or a second run over the same folder.
+
+    :param ttl: seconds after which a result expires, None to keep results
+    :param max_entries: least recently used results are removed above this size
+    """
+
+    def __init__(self, path, ttl=None, max_entries=100000):
+        self.path = str(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results "
+            "(key TEXT PRIMARY KEY, result TEXT, created REAL, used REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+        self._db.commit()
+
+    @staticmethod
+    def key(
+        fp,
+        regions=None,
+        config=None,
+        camera_id=None,
+        timestamp=None,
+        mmc=None,
+        url=None,
+    ):
+        """
+        Hash the whole content of fp, whatever its position, and leave the
+        position unchanged.
+
+        :param url: API endpoint, the Cloud, an SDK or the container-api
+            return different results for the same image
+        """
+        digest = hashlib.sha256()
+        if isinstance(fp, bytes):
+            digest.update(fp)
+        else:
+            position = fp.tell()
+            fp.seek(0)
+            for chunk in iter(partial(fp.read, 1 << 20), b""):
+                digest.update(chunk)
+            fp.seek(position)
+        params = json.dumps(
+            [regions, config, camera_id, timestamp, bool(mmc), url], sort_keys=True
+        )
+        digest.update(params.encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT result, created FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row and self.ttl is not None and now - row[1] > self.ttl:
+                self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+                self._db.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute("UPDATE results SET used = ? WHERE key = ?", (now, key))
+            self._db.commit()
+        return json.loads(row[0], object_pairs_hook=OrderedDict)
+
+    def put(self, key, result):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                (key, json.dumps(result), now, now),
             )
-            candidates = flatten(data.copy())
-            for candidate in candidates:
-                if len(fieldnames) < len(candidate):
-                    fieldnames = candidate.keys()
-        with open(path, "w", newline="") as fp:
-            writer = csv.DictWriter(fp, fieldnames=fieldnames)
-            writer.writeheader()
-            for result in results:
-                result_data = (
-                    transform_result(result)
-                    if is_detection_mode_vehicle(args.engine_config)
-                    else result
-                )
-                flattened_results = flatten(result_data)
-                for flattened_result in flattened_results:
-                    writer.writerow(flattened_result)
+            self._db.execute(
+                "DELETE FROM results WHERE key IN "
+                "(SELECT key FROM results ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._db.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0
+        return (
+            f"Cache: {self.hits} hit(s), {self.misses} miss(es), "
+            f"{rate:.0f}% of API calls saved"
+        )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def configure_cache(cache):
+    """
+    Use cache in all the following recognition_api calls
+    """
+    global _cache
+    _cache = cache
+
+
+def open_cache(args):
+    if not getattr(args, "cache", None):
+        return None
+    cache = ResultCache(args.cache, args.cache_ttl, args.cache_size)
+    configure_cache(cache)
+    return cache
+
+
+def close_cache(cache):
+    if cache:
+        print(cache.stats(), file=sys.stderr)
+        cache.close()
+        configure_cache(None)
+
+
+def add_tile_encoder_arguments(parser):
+    parser.add_argument(
+        "--tile-quality",
+        type=int,
+        default=95,
+        help="JPEG quality of the image parts sent when splitting.",
+    )
+    parser.add_argument(
+        "--tile-scale",
+        type=float,
+        default=1.0,
+        help="Resize the image parts by this factor before sending them. For example, 0.5.",
+    )
+    parser.add_argument(
+        "--tile-encoder",
+        default="pil",
+        choices="pil opencv".split(),
+        help="Library used to encode the image parts. opencv requires opencv-python.",
+    )
+
+
+def add_cache_arguments(parser):
+    parser.add_argument(
+        "--cache",
+        type=Path,
+        help="Cache results in this SQLite file and reuse them for identical images.",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        help="Seconds after which a cached result expires. Default: never.",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=100000,
+        help="Maximum number of cached results, least recently used are removed.",
+    )
+
+
+def open_journal(args, default_path):
+    if not args.resume and not args.journal:
+        return None
+    journal = Journal(args.journal or default_path, resume=args.resume)
+    if args.resume:
+        print(
+            f"Resuming from {journal.path}, {journal.completed} image(s) already processed.",
+            file=sys.stderr,
+        )
+    return journal
 
 
 def custom_args(parser):
@@ -337,7 +988,7 @@ Enable Make Model and Color prediction:
         "--format",
         help="Format of the result.",
         default="json",
-        choices="json csv".split(),
+        choices="json jsonl csv".split(),
     )
     parser.add_argument(
         "--mmc",
@@ -370,31 +1021,94 @@ Enable Make Model and Color prediction:
         default=10,
         help="Percentage of window overlap when splitting",
     )
+    parser.add_argument(
+        "--split-adaptive",
+        action="store_true",
+        help="Send the entire image first and only the parts likely to contain "
+        "missed plates: small or low score detections, or all the parts when "
+        "nothing was found.",
+    )
+    parser.add_argument(
+        "--split-min-megapixels",
+        type=float,
+        default=2.0,
+        help="With --split-adaptive, smaller images are not split.",
+    )
+    parser.add_argument(
+        "--split-min-score",
+        type=float,
+        default=0.5,
+        help="With --split-adaptive, parts of the image with a detection below "
+        "this score are sent.",
+    )
+    parser.add_argument(
+        "--split-workers",
+        type=int,
+        default=4,
+        help="Number of image parts sent to the API concurrently when splitting.",
+    )
+    add_tile_encoder_arguments(parser)
+    add_rate_limit_arguments(parser)
+    add_cache_arguments(parser)
+    parser.add_argument(
+        "--journal",
+        type=Path,
+        help="Record processed images and their results in this file. Defaults to plate_recognition.journal when resuming.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip images already recorded in the journal and reuse their results.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of images processed concurrently.",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        help="Maximum number of images queued or being processed. Defaults to 2 x workers.",
+    )
+    parser.add_argument(
+        "--postprocess-workers",
+        type=int,
+        default=0,
+        help="Number of processes drawing boxes and saving crops. "
+        "Default: done by the worker that sent the image.",
+    )
+
+
+@lru_cache(maxsize=None)
+def load_font(size=10):
+    font_path = Path(__file__).parent / "assets" / "DejaVuSansMono.ttf"
+    if font_path.exists():
+        return ImageFont.truetype(str(font_path), size)
+    return ImageFont.load_default()
+
+
+@lru_cache(maxsize=4096)
+def text_size(font, text):
+    left, top, right, bottom = font.getbbox(text)
+    return right - left, bottom - top
 
 
 def draw_bb(im, data, new_size=(1920, 1050), text_func=None):
     draw = ImageDraw.Draw(im)
-    font_path = Path("assets/DejaVuSansMono.ttf")
-    if font_path.exists():
-        font = ImageFont.truetype(str(font_path), 10)
-    else:
-        font = ImageFont.load_default()
+    font = load_font()
     rect_color = (0, 255, 0)
     for result in data:
         b = result["box"]
-        coord = [(b["xmin"], b["ymin"]), (b["xmax"], b["ymax"])]
-        draw.rectangle(coord, outline=rect_color)
-        draw.rectangle(
-            ((coord[0][0] - 1, coord[0][1] - 1), (coord[1][0] - 1, coord[1][1] - 1)),
-            outline=rect_color,
-        )
+        # 3 pixels wide outline, extending up and left of the box
         draw.rectangle(
-            ((coord[0][0] - 2, coord[0][1] - 2), (coord[1][0] - 2, coord[1][1] - 2)),
+            ((b["xmin"] - 2, b["ymin"] - 2), (b["xmax"], b["ymax"])),
             outline=rect_color,
+            width=3,
         )
         if text_func:
             text = text_func(result)
-            (text_width, text_height) = font.font.getsize(text)[0]
+            (text_width, text_height) = text_size(font, text)
             margin = math.ceil(0.05 * text_height)
             draw.rectangle(
                 [
@@ -419,106 +1133,332 @@ def text_function(result):
     return result["plate"]
 
 
-def bb_iou(a, b):
-    # determine the (x, y)-coordinates of the intersection rectangle
-    x_a = max(a["xmin"], b["xmin"])
-    y_a = max(a["ymin"], b["ymin"])
-    x_b = min(a["xmax"], b["xmax"])
-    y_b = min(a["ymax"], b["ymax"])
-
-    # compute the area of both the prediction and ground-truth
-    # rectangles
-    area_a = (a["xmax"] - a["xmin"]) * (a["ymax"] - a["ymin"])
-    area_b = (b["xmax"] - b["xmin"]) * (b["ymax"] - b["ymin"])
-
-    # compute the area of intersection rectangle
-    area_inter = max(0, x_b - x_a) * max(0, y_b - y_a)
-    return area_inter / float(max(area_a + area_b - area_inter, 1))
-
-
 def clean_objs(objects, threshold=0.1):
     # Only keep the ones with best score or no overlap
-    for o1, o2 in combinations(objects, 2):
-        if (
-            "remove" in o1
-            or "remove" in o2
-            or bb_iou(o1["box"], o2["box"]) <= threshold
-        ):
-            continue
-        if o1["score"] > o2["score"]:
-            o2["remove"] = True
-        else:
-            o1["remove"] = True
-    return [x for x in objects if "remove" not in x]
+    keep = suppress_overlaps(
+        [o["box"] for o in objects], [o["score"] for o in objects], threshold
+    )
+    return [objects[i] for i in keep]
 
 
-def merge_results(images):
-    result = dict(results=[])
+def offset_results(images):
+    """
+    Detections of all the tiles, moved to the coordinates of the entire image
+    """
+    results = []
     for data in images:
         for item in data["prediction"]["results"]:
-            result["results"].append(item)
+            results.append(item)
             for b in [item["box"], item["vehicle"].get("box", {})]:
                 b["ymin"] += data["y"]
                 b["xmin"] += data["x"]
                 b["ymax"] += data["y"]
                 b["xmax"] += data["x"]
-    result["results"] = clean_objs(result["results"])
-    return result
+    return results
 
 
-def inside(a, b):
-    return (
-        a["xmin"] > b["xmin"]
-        and a["ymin"] > b["ymin"]
-        and a["xmax"] < b["xmax"]
-        and a["ymax"] < b["ymax"]
-    )
+def merge_results(images):
+    return dict(results=clean_objs(offset_results(images)))
 
 
 def post_processing(results):
-    new_list = []
-    for item in results["results"]:
-        if item["score"] < 0.2 and any(
-            [inside(x["box"], item["box"]) for x in results["results"] if x != item]
-        ):
-            continue
-        new_list.append(item)
-    results["results"] = new_list
+    # Remove low score detections that contain another detection
+    items = results["results"]
+    keep = suppress_contained([x["box"] for x in items], [x["score"] for x in items])
+    results["results"] = [items[i] for i in keep]
     return results
 
 
-def output_image(args, path, results):
+def has_image_output(args):
+    return bool(
+        args.show_boxes or args.annotate_images or args.crop_lp or args.crop_vehicle
+    )
+
+
+class PostProcessor:
+    """
+    Run output_image in a pool of processes so that drawing, cropping and
+    encoding use all the cores while the threads wait for the API.
+
+    Images are handed over by path and decoded by the worker process. At most
+    2 x workers images are waiting at the same time.
+    """
+
+    def __init__(self, args, workers):
+        # Only the options used by output_image are sent to the processes
+        self.args = argparse.Namespace(
+            show_boxes=args.show_boxes,
+            annotate_images=args.annotate_images,
+            crop_lp=args.crop_lp,
+            crop_vehicle=args.crop_vehicle,
+        )
+        self.max_pending = 2 * workers
+        self._executor = ProcessPoolExecutor(max_workers=workers)
+        self._pending = deque()
+
+    def submit(self, path, results):
+        while len(self._pending) >= self.max_pending:
+            self._pending.popleft().result()
+        self._pending.append(
+            self._executor.submit(output_image, self.args, path, results)
+        )
+
+    def close(self):
+        try:
+            while self._pending:
+                self._pending.popleft().result()
+        finally:
+            self._executor.shutdown()
+
+
+def output_image(args, path, results, context=None):
+    context = context or ImageContext(path)
+    # Crop first, the boxes are drawn on the same image
+    if args.crop_lp or args.crop_vehicle:
+        save_cropped(results, path, args, context.image)
     if args.show_boxes or args.annotate_images and "results" in results:
-        image = Image.open(path)
-        annotated_image = draw_bb(image, results["results"], None, text_function)
+        annotated_image = draw_bb(
+            context.source_image(), results["results"], None, text_function
+        )
         if args.show_boxes:
             annotated_image.show()
         if args.annotate_images:
             annotated_image.save(path.with_name(f"{path.stem}_annotated{path.suffix}"))
-    if args.crop_lp or args.crop_vehicle:
-        save_cropped(results, path, args)
 
 
-def process_split_image(path, args, engine_config):
-    if args.split_x == 0 or args.split_y == 0:
-        raise ValueError("Please specify --split-x or --split-y")
+class TileEncoder:
+    """
+    Encode image tiles before they are sent to the API
+
+    :param quality: JPEG quality
+    :param scale: resize factor applied before encoding, boxes returned by the
+        API are scaled back to the original tile size
+    :param backend: pil or opencv. OpenCV is usually faster to encode JPEG.
+    """
+
+    def __init__(self, quality=95, scale=1.0, backend="pil"):
+        self.quality = quality
+        self.scale = scale
+        self.backend = backend
+        if backend == "opencv":
+            try:
+                import cv2
+                import numpy
+            except ImportError:
+                print(
+                    "A dependency is missing. Please install: "
+                    "https://pypi.org/project/opencv-python-headless/"
+                )
+                exit(1)
+            self._cv2 = cv2
+            self._numpy = numpy
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(
+            getattr(args, "tile_quality", 95),
+            getattr(args, "tile_scale", 1.0),
+            getattr(args, "tile_encoder", "pil"),
+        )
+
+    def encode(self, im):
+        """
+        :return: (encoded image file, encoding time in milliseconds)
+        """
+        now = default_timer()
+        if self.scale != 1.0:
+            im = im.resize(
+                (
+                    max(1, round(im.width * self.scale)),
+                    max(1, round(im.height * self.scale)),
+                )
+            )
+        if self.backend == "opencv":
+            _, buffer = self._cv2.imencode(
+                ".jpg",
+                self._numpy.asarray(im)[:, :, ::-1],  # RGB to BGR
+                [self._cv2.IMWRITE_JPEG_QUALITY, self.quality],
+            )
+            im_bytes = io.BytesIO(buffer.tobytes())
+        else:
+            im_bytes = io.BytesIO()
+            im.save(im_bytes, "JPEG", quality=self.quality)
+            im_bytes.seek(0)
+        return im_bytes, (default_timer() - now) * 1000
+
+    def rescale(self, prediction):
+        if self.scale == 1.0:
+            return prediction
+        for item in prediction.get("results", []):
+            for b in [item["box"], item["vehicle"].get("box", {})]:
+                for key in b:
+                    b[key] = round(b[key] / self.scale)
+        return prediction
+
+
+def recognize_tile(tile, api_call, encoder):
+    (x, y), im = tile
+    if isinstance(im, bytes):
+        # Original file content, sent untouched
+        prediction = api_call(io.BytesIO(im))
+        return dict(prediction=prediction, x=x, y=y, encode_time=0.0)
+    im_bytes, encode_time = encoder.encode(im)
+    prediction = encoder.rescale(api_call(im_bytes))
+    return dict(prediction=prediction, x=x, y=y, encode_time=encode_time)
+
+
+def recognize_tiles(tiles, api_call, workers, encoder=None):
+    """
+    Encode and send the tiles of an image concurrently
+
+    :param tiles: list of ((x, y), image) where (x, y) is the tile offset.
+        image is either a PIL image or the bytes of the original file.
+    :param api_call: function sending one encoded tile to the API
+    :param workers: maximum number of tiles sent at the same time
+    :param encoder: TileEncoder used for PIL images
+    :return: list of dict(prediction, x, y, encode_time) in the same order as tiles
+    """
+    func = partial(recognize_tile, api_call=api_call, encoder=encoder or TileEncoder())
+    if workers <= 1:
+        return [func(tile) for tile in tiles]
+    with ThreadPoolExecutor(max_workers=min(workers, len(tiles))) as executor:
+        return list(executor.map(func, tiles))
+
+
+def original_bytes(path, im):
+    """
+    Content of the image file if it can be sent to the API as is. Boxes must
+    match the decoded pixels, so rotated images (EXIF orientation) are excluded.
+    """
+    if im.format not in ("JPEG", "PNG", "WEBP") or im.getexif().get(0x0112, 1) != 1:
+        return None
+    with open(path, "rb") as fp:
+        return fp.read()
+
+
+class ImageContext:
+    """
+    Image decoded once and shared by the tiling, crops, annotation and blur of
+    the same file. The file is only decoded when the pixels are first needed.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._image = None
+        self._original = None
+        self.mode = None
+
+    def _decode(self):
+        im = Image.open(self.path)
+        self.mode = im.mode
+        self._original = original_bytes(self.path, im)
+        if im.mode != "RGB":
+            im = im.convert("RGB")
+        else:
+            im.load()
+        self._image = im
+
+    @property
+    def image(self):
+        """
+        RGB image, drawing on it changes it for all the following users
+        """
+        if self._image is None:
+            self._decode()
+        return self._image
+
+    @property
+    def original(self):
+        """
+        Content of the file if it can be sent to the API as is, see original_bytes
+        """
+        if self._image is None:
+            self._decode()
+        return self._original
+
+    def source_image(self):
+        """
+        Image in the mode of the file, for outputs that keep it like the
+        alpha channel of a PNG. The file is decoded again unless it is RGB.
+        Grayscale files use the RGB image, colored boxes can not be drawn on
+        them.
+        """
+        if self._image is None:
+            self._decode()
+        if self.mode == "RGB" or (
+            self.mode != "P" and Image.getmodebands(self.mode) < 3
+        ):
+            return self._image
+        return Image.open(self.path)
+
+
+# Plates narrower than this fraction of the image width are likely to be missed
+# or misread in the full frame pass
+SMALL_PLATE_WIDTH = 0.02
 
-    # Predictions
-    fp = Image.open(path)
-    if fp.mode != "RGB":
-        fp = fp.convert("RGB")
-    images = [((0, 0), fp)]  # Entire image
 
+def report_encode_times(path, results):
+    times = [r["encode_time"] for r in results if r["encode_time"]]
+    if times:
+        print(
+            f"{Path(path).name}: encoded {len(times)} tile(s) in {sum(times):.1f}ms "
+            f"({', '.join(f'{t:.1f}' for t in times)})",
+            file=sys.stderr,
+        )
+
+
+def select_tiles(tiles, prediction, size, args):
+    """
+    Tiles worth sending after the full frame pass of an adaptive split.
+
+    Images smaller than args.split_min_megapixels are not split. Otherwise all
+    the tiles are sent when nothing was found, else only the tiles overlapping
+    a detection that is small or has a score below args.split_min_score.
+
+    :param tiles: list of ((x, y), (xmin, ymin, xmax, ymax))
+    :param prediction: API result of the full frame
+    :param size: (width, height) of the image
+    """
+    width, height = size
+    if width * height < args.split_min_megapixels * 1e6:
+        return []
+    detections = prediction.get("results", [])
+    if not detections:
+        return tiles
+    uncertain = [
+        d["box"]
+        for d in detections
+        if d["score"] < args.split_min_score
+        or d["box"]["xmax"] - d["box"]["xmin"] < SMALL_PLATE_WIDTH * width
+    ]
+    return [
+        (offset, box)
+        for offset, box in tiles
+        if any(
+            b["xmin"] < box[2]
+            and box[0] < b["xmax"]
+            and b["ymin"] < box[3]
+            and box[1] < b["ymax"]
+            for b in uncertain
+        )
+    ]
+
+
+def split_tiles(width, height, args):
+    """
+    Overlapping parts of the image sent with --split-image
+
+    :return: list of ((x, y), (xmin, ymin, xmax, ymax))
+    """
+    tiles = []
     overlap_pct = args.split_overlap
 
-    window_width = fp.width / (args.split_x + 1)
-    window_height = fp.height / (args.split_y + 1)
+    window_width = width / (args.split_x + 1)
+    window_height = height / (args.split_y + 1)
 
     overlap_width = int(window_width * overlap_pct / 100)
     overlap_height = int(window_height * overlap_pct / 100)
 
-    draw = ImageDraw.Draw(fp)
-
     for i in range(args.split_x + 1):
         for j in range(args.split_y + 1):
             ymin = j * window_height
@@ -547,29 +1487,57 @@ def process_split_image(path, args, engine_config):
                 ymin = ymin - overlap_height
                 ymax = ymax + overlap_height
 
-            images.append(((xmin, ymin), fp.crop((xmin, ymin, xmax, ymax))))
+            tiles.append(((xmin, ymin), (xmin, ymin, xmax, ymax)))
+    return tiles
+
+
+def process_split_image(path, args, engine_config):
+    if args.split_x == 0 or args.split_y == 0:
+        raise ValueError("Please specify --split-x or --split-y")
+
+    # Predictions
+    context = ImageContext(path)
+    fp = context.image
+    full_image = ((0, 0), context.original or fp)  # Entire image
+    tiles = split_tiles(fp.width, fp.height, args)
 
     # Inference
     api_results = {}
-    results = []
     usage = []
     camera_ids = []
     timestamps = []
     processing_times = []
-    for (x, y), im in images:
-        im_bytes = io.BytesIO()
-        im.save(im_bytes, "JPEG", quality=95)
-        im_bytes.seek(0)
-        api_res = recognition_api(
-            im_bytes,
-            args.regions,
-            args.api_key,
-            args.sdk_url,
-            config=engine_config,
-            camera_id=args.camera_id,
-            mmc=args.mmc,
+    api_call = partial(
+        recognition_api,
+        regions=args.regions,
+        api_key=args.api_key,
+        sdk_url=args.sdk_url,
+        config=engine_config,
+        camera_id=args.camera_id,
+        mmc=args.mmc,
+    )
+    encoder = TileEncoder.from_args(args)
+    if args.split_adaptive:
+        # Full frame first, then only the tiles likely to contain missed plates
+        results = recognize_tiles([full_image], api_call, 1, encoder)
+        selected = select_tiles(tiles, results[0]["prediction"], fp.size, args)
+        print(
+            f"{Path(path).name}: {len(selected)}/{len(tiles)} tile(s) sent",
+            file=sys.stderr,
         )
-        results.append(dict(prediction=api_res, x=x, y=y))
+        if selected:
+            results += recognize_tiles(
+                [(offset, fp.crop(box)) for offset, box in selected],
+                api_call,
+                args.split_workers,
+                encoder,
+            )
+    else:
+        images = [full_image] + [(offset, fp.crop(box)) for offset, box in tiles]
+        results = recognize_tiles(images, api_call, args.split_workers, encoder)
+    report_encode_times(path, results)
+    for data in results:
+        api_res = data["prediction"]
         if "usage" in api_res:
             usage.append(api_res["usage"])
         camera_ids.append(api_res["camera_id"])
@@ -597,7 +1565,8 @@ def process_split_image(path, args, engine_config):
         b["xmax"] = b["xmax"] + padding_x
         b["ymax"] = b["ymax"] + padding_y
 
-    output_image(args, path, results)
+    if not args.postprocess_workers:
+        output_image(args, path, results, context)
     return results
 
 
@@ -613,13 +1582,55 @@ def process_full_image(path, args, engine_config):
             mmc=args.mmc,
         )
 
-    output_image(args, path, api_res)
+    if not args.postprocess_workers:
+        output_image(args, path, api_res)
     return api_res
 
 
+def process_path(path, args, engine_config):
+    """
+    Process a single image and measure how long it took
+
+    :return: (result, latency in milliseconds)
+    """
+    now = default_timer()
+    if args.split_image:
+        result = process_split_image(path, args, engine_config)
+    else:
+        result = process_full_image(path, args, engine_config)
+    return result, (default_timer() - now) * 1000
+
+
+def process_or_resume(path, args, engine_config, journal=None):
+    """
+    Reuse the journal result of an already processed image, otherwise process it
+
+    :return: (result, latency in milliseconds or None if the result was reused)
+    """
+    if journal:
+        result = journal.get(Journal.key(path))
+        if result is not None:
+            return result, None
+    return process_path(path, args, engine_config)
+
+
+def bounded_map(executor, func, items, max_in_flight):
+    """
+    Like executor.map but never submits more than max_in_flight items at once.
+    Results are yielded in the same order as items.
+    """
+    pending = deque()
+    for item in items:
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, item))
+    while pending:
+        yield pending.popleft().result()
+
+
 def main():
     args = parse_arguments(custom_args)
-    paths = args.files
+    paths = [path for path in args.files if path.exists() and path.is_file()]
 
     results = []
     engine_config = {}
@@ -629,17 +1640,65 @@ def main():
         except json.JSONDecodeError as e:
             print(e)
             return
-    for path in paths:
-        if not path.exists():
-            continue
-        if Path(path).is_file():
-            if args.split_image:
-                results.append(process_split_image(path, args, engine_config))
-            else:
-                results.append(process_full_image(path, args, engine_config))
+    writer = None
     if args.output_file:
-        save_results(results, args)
+        writer = open_result_writer(args)
+        if writer is None:
+            return
+    journal = open_journal(args, "plate_recognition.journal")
+    workers = max(1, args.workers)
+    max_in_flight = max(workers, args.max_in_flight or 2 * workers)
+    configure_client(
+        pool_size=workers * (max(1, args.split_workers) if args.split_image else 1),
+        limiter=make_rate_limiter(args),
+    )
+    cache = open_cache(args)
+    postprocessor = None
+    if args.postprocess_workers > 0 and has_image_output(args):
+        postprocessor = PostProcessor(args, args.postprocess_workers)
     else:
+        args.postprocess_workers = 0
+    started = default_timer()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        processed = bounded_map(
+            executor,
+            partial(
+                process_or_resume,
+                args=args,
+                engine_config=engine_config,
+                journal=journal,
+            ),
+            paths,
+            max_in_flight,
+        )
+        try:
+            for i, (path, (result, latency)) in enumerate(zip(paths, processed), 1):
+                if latency is None:
+                    status = "resumed"
+                else:
+                    status = f"{latency:.1f}ms"
+                    if journal:
+                        journal.add(Journal.key(path), result)
+                    if postprocessor:
+                        postprocessor.submit(path, result)
+                if writer:
+                    writer.write(result)
+                else:
+                    results.append(result)
+                print(
+                    f"[{i}/{len(paths)}] {path} {status} "
+                    f"({i / (default_timer() - started):.1f} images/s)",
+                    file=sys.stderr,
+                )
+        finally:
+            if writer:
+                writer.close()
+            if journal:
+                journal.close()
+            close_cache(cache)
+            if postprocessor:
+                postprocessor.close()
+    if not writer:
         print(json.dumps(results, indent=2))
 
 
@@ -0,0 +1,711 @@
+import argparse
+import asyncio
+import gzip
+import io
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import mock
+
+import pytest
+import requests
+from PIL import Image, ImageChops
+
+import box_utils
+from ftp_and_sftp_processor import FileTransferProcessor, SeenFiles, process_cameras
+from number_plate_redaction import blur, group_boxes
+from plate_recognition import (
+    ApiClient,
+    ImageContext,
+    Journal,
+    RateLimiter,
+    ResultCache,
+    ResultWriter,
+    SharedRateLimiter,
+    clean_objs,
+    custom_args,
+    output_image,
+    parse_arguments,
+    post_processing,
+    process_or_resume,
+    recognition_api,
+    select_tiles,
+)
+
+
+def random_detections(rng, count):
+    detections = []
+    for _ in range(count):
+        x, y = rng.randint(0, 400), rng.randint(0, 300)
+        w, h = rng.randint(5, 120), rng.randint(5, 60)
+        detections.append(
+            dict(
+                box=dict(xmin=x, ymin=y, xmax=x + w, ymax=y + h),
+                score=round(rng.uniform(0, 1), 2),
+            )
+        )
+    return detections
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_box_filters_match_python_implementation(seed):
+    rng = random.Random(seed)
+    detections = random_detections(rng, rng.randint(0, 60))
+    boxes = [d["box"] for d in detections]
+    scores = [d["score"] for d in detections]
+
+    assert box_utils.suppress_overlaps(
+        boxes, scores
+    ) == box_utils._suppress_overlaps_py(boxes, scores, 0.1)
+    assert box_utils.suppress_contained(
+        boxes, scores
+    ) == box_utils._suppress_contained_py(boxes, scores, 0.2)
+
+
+def test_clean_objs_removed_box_does_not_remove_others():
+    a = dict(box=dict(xmin=0, ymin=0, xmax=10, ymax=10), score=0.5)
+    b = dict(box=dict(xmin=5, ymin=0, xmax=15, ymax=10), score=0.7)
+    c = dict(box=dict(xmin=10, ymin=0, xmax=20, ymax=10), score=0.9)
+    # b removes a, then c removes b. a does not overlap c.
+    assert clean_objs([a, b, c]) == [c]
+
+
+def test_post_processing_removes_low_score_container():
+    outer = dict(box=dict(xmin=0, ymin=0, xmax=100, ymax=100), score=0.1)
+    inner = dict(box=dict(xmin=10, ymin=10, xmax=20, ymax=20), score=0.9)
+    confident = dict(box=dict(xmin=200, ymin=0, xmax=300, ymax=100), score=0.9)
+    inner2 = dict(box=dict(xmin=210, ymin=10, xmax=220, ymax=20), score=0.9)
+    results = post_processing(dict(results=[outer, inner, confident, inner2]))
+    assert results["results"] == [inner, confident, inner2]
+
+
+def test_box_filters_without_numpy(monkeypatch):
+    monkeypatch.setattr(box_utils, "np", None)
+    a = dict(xmin=0, ymin=0, xmax=10, ymax=10)
+    b = dict(xmin=1, ymin=1, xmax=9, ymax=9)
+    assert box_utils.suppress_overlaps([a, b], [0.1, 0.9]) == [1]
+    assert box_utils.suppress_contained([a, b], [0.1, 0.9]) == [1]
+
+
+def test_api_client_retries_rate_limited_calls():
+    client = ApiClient(retries=2)
+    limited = mock.Mock(status_code=429, headers={"Retry-After": "0"})
+    created = mock.Mock(status_code=201, headers={})
+    fp = io.BytesIO(b"image")
+    with mock.patch.object(client.session, "post", side_effect=[limited, created]):
+        fp.read()
+        assert (
+            client.post("http://sdk/v1/plate-reader/", files=dict(upload=fp)) is created
+        )
+    assert fp.tell() == 0
+
+
+def test_api_client_only_retries_connection_errors():
+    client = ApiClient(retries=2, backoff=0)
+    created = mock.Mock(status_code=201, headers={})
+    with mock.patch.object(
+        client.session, "post", side_effect=[requests.ConnectTimeout(), created]
+    ) as post:
+        assert client.post("http://sdk/v1/plate-reader/") is created
+    assert post.call_count == 2
+    with mock.patch.object(
+        client.session, "post", side_effect=[requests.ReadTimeout(), created]
+    ) as post:
+        with pytest.raises(requests.ReadTimeout):
+            client.post("http://sdk/v1/plate-reader/")
+    assert post.call_count == 1
+
+
+def test_api_client_backoff():
+    client = ApiClient(backoff=1, max_backoff=4)
+    assert client.delay(0, mock.Mock(headers={"Retry-After": "2"})) == 2
+    assert 0 <= client.delay(10) <= 4
+
+
+def test_rate_limiter_spaces_calls_after_burst():
+    limiter = RateLimiter(rate=10, burst=2)
+    delays = [limiter.reserve() for _ in range(4)]
+    assert delays[:2] == [0, 0]
+    assert delays[2] == pytest.approx(0.1, abs=0.01)
+    assert delays[3] == pytest.approx(0.2, abs=0.01)
+
+
+def test_shared_rate_limiter_is_shared_through_the_file(tmp_path):
+    first = SharedRateLimiter(rate=10, burst=1, path=tmp_path / "rate.lock")
+    second = SharedRateLimiter(rate=10, burst=1, path=tmp_path / "rate.lock")
+    assert first.reserve() == 0
+    assert second.reserve() == pytest.approx(0.1, abs=0.01)
+
+
+def test_journal_resume_skips_processed_images(tmp_path):
+    images = []
+    for name in "abc":
+        images.append(tmp_path / f"{name}.jpg")
+        images[-1].write_bytes(name.encode())
+    journal = Journal(tmp_path / "run.journal")
+    for path in images[:2]:
+        journal.add(Journal.key(path), {"filename": path.name, "results": []})
+    journal.close()
+
+    journal = Journal(tmp_path / "run.journal", resume=True)
+    assert journal.completed == 2
+    with mock.patch(
+        "plate_recognition.process_path", return_value=({"results": []}, 10.0)
+    ) as process_path:
+        resumed = [process_or_resume(path, None, {}, journal) for path in images]
+    assert resumed[0] == ({"filename": "a.jpg", "results": []}, None)
+    assert resumed[1] == ({"filename": "b.jpg", "results": []}, None)
+    assert resumed[2] == ({"results": []}, 10.0)
+    process_path.assert_called_once_with(images[2], None, {})
+    journal.close()
+
+
+def test_journal_resume_ignores_truncated_last_line(tmp_path):
+    path = tmp_path / "run.journal"
+    journal = Journal(path)
+    journal.add("a", {"results": ["a"]})
+    journal.close()
+    with open(path, "ab") as fp:
+        fp.write(b'"b"\t{"results": [')  # Interrupted while writing
+
+    journal = Journal(path, resume=True)
+    assert journal.completed == 1
+    assert journal.get("b") is None
+    journal.add("b", {"results": ["b"]})
+    journal.close()
+
+    journal = Journal(path, resume=True)
+    assert journal.completed == 2
+    assert journal.get("a") == {"results": ["a"]}
+    assert journal.get("b") == {"results": ["b"]}
+    journal.close()
+
+
+def test_result_cache_key_depends_on_image_and_parameters():
+    fp = io.BytesIO(b"image")
+    key = ResultCache.key(fp, ["fr"], {"region": "strict"})
+    assert fp.tell() == 0
+    assert key == ResultCache.key(b"image", ["fr"], {"region": "strict"})
+    assert key != ResultCache.key(b"image", ["it"], {"region": "strict"})
+    assert key != ResultCache.key(b"other", ["fr"], {"region": "strict"})
+    assert key != ResultCache.key(b"image", ["fr"], {"region": "strict"}, mmc=True)
+    assert key != ResultCache.key(
+        b"image", ["fr"], {"region": "strict"}, url="http://sdk/v1/plate-reader/"
+    )
+
+
+def test_result_cache_key_hashes_files_positioned_at_the_end():
+    first, second = io.BytesIO(b"image"), io.BytesIO(b"other")
+    first.seek(0, io.SEEK_END)
+    second.seek(0, io.SEEK_END)
+    assert ResultCache.key(first) == ResultCache.key(b"image")
+    assert ResultCache.key(first) != ResultCache.key(second)
+    assert first.tell() == len(b"image")
+
+
+def test_result_cache_ttl_and_eviction(tmp_path):
+    cache = ResultCache(tmp_path / "cache.sqlite", max_entries=2)
+    for key in "abc":
+        cache.put(key, {"results": [key]})
+    assert cache.get("a") is None
+    assert cache.get("c") == {"results": ["c"]}
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.ttl = 0
+    with mock.patch("time.time", return_value=time.time() + 1):
+        assert cache.get("c") is None
+    cache.close()
+
+
+def test_recognition_api_uses_cache(tmp_path):
+    cache = ResultCache(tmp_path / "cache.sqlite")
+    client = ApiClient()
+    response = mock.Mock(status_code=201, headers={})
+    response.json.return_value = {"results": []}
+    with mock.patch.object(client.session, "post", return_value=response) as post:
+        for _ in range(3):
+            assert recognition_api(
+                io.BytesIO(b"image"), sdk_url="http://sdk", client=client, cache=cache
+            ) == {"results": []}
+    assert post.call_count == 1
+    assert (cache.hits, cache.misses) == (2, 1)
+    with mock.patch.object(client.session, "post", return_value=response) as post:
+        recognition_api(
+            io.BytesIO(b"image"), sdk_url="http://other-sdk", client=client, cache=cache
+        )
+    assert post.call_count == 1
+    cache.close()
+
+
+def test_recognition_api_cache_hit_uses_the_current_filename(tmp_path):
+    cache = ResultCache(tmp_path / "cache.sqlite")
+    client = ApiClient()
+    response = mock.Mock(status_code=201, headers={})
+    response.json.return_value = {"filename": "cam1.jpg", "results": []}
+    with mock.patch.object(client.session, "post", return_value=response) as post:
+        for name in ["cam1.jpg", "cam2.jpg"]:
+            fp = io.BytesIO(b"image")
+            fp.seek(0, io.SEEK_END)
+            result = recognition_api(
+                fp, sdk_url="http://sdk", client=client, cache=cache, filename=name
+            )
+            assert result["filename"] == name
+    assert post.call_count == 1
+    cache.close()
+
+
+def plate_reader_app(responses, calls):
+    """
+    aiohttp application answering /v1/plate-reader/ with the next of
+    responses, a list of (status, headers, body)
+    """
+    from aiohttp import web
+
+    async def plate_reader(request):
+        form = await request.post()
+        calls.append((time.monotonic(), form["upload"].filename))
+        status, headers, body = responses.pop(0) if responses else (201, {}, None)
+        if body is None:
+            body = {"filename": form["upload"].filename, "results": []}
+        return web.json_response(body, status=status, headers=headers)
+
+    app = web.Application()
+    app.router.add_post("/v1/plate-reader/", plate_reader)
+    return app
+
+
+def test_async_client_retries_with_retry_after():
+    pytest.importorskip("aiohttp")
+    from aiohttp.test_utils import TestServer
+
+    from async_recognition import AsyncRecognitionClient
+
+    responses = [
+        (429, {"Retry-After": "0.3"}, {"detail": "Too many requests"}),
+        (503, {}, {"detail": "Unavailable"}),
+    ]
+    calls = []
+
+    async def recognize():
+        async with TestServer(plate_reader_app(responses, calls)) as server:
+            sdk_url = str(server.make_url("")).rstrip("/")
+            async with AsyncRecognitionClient(
+                sdk_url=sdk_url, retries=3, backoff=0.01, max_backoff=5
+            ) as client:
+                return await client.recognition(b"image", filename="car.jpg")
+
+    assert asyncio.run(recognize()) == {"filename": "car.jpg", "results": []}
+    assert len(calls) == 3
+    # Retry-After is used instead of the short backoff
+    assert 0.3 <= calls[1][0] - calls[0][0] < 2
+    assert calls[2][0] - calls[1][0] < 0.3
+
+
+def test_async_client_returns_the_error_after_the_last_retry():
+    pytest.importorskip("aiohttp")
+    from aiohttp.test_utils import TestServer
+
+    from async_recognition import AsyncRecognitionClient
+
+    responses = [(429, {"Retry-After": "0"}, {"detail": "Too many requests"})] * 3
+    calls = []
+
+    async def recognize():
+        async with TestServer(plate_reader_app(responses, calls)) as server:
+            sdk_url = str(server.make_url("")).rstrip("/")
+            async with AsyncRecognitionClient(sdk_url=sdk_url, retries=1) as client:
+                return await client.recognition(b"image")
+
+    assert asyncio.run(recognize()) == {"detail": "Too many requests"}
+    assert len(calls) == 2
+
+
+def test_async_client_does_not_retry_read_timeouts():
+    pytest.importorskip("aiohttp")
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    from async_recognition import AsyncRecognitionClient
+
+    calls = []
+
+    async def slow(request):
+        calls.append(request.path)
+        await asyncio.sleep(1)
+        return web.json_response({"results": []})
+
+    async def recognize():
+        app = web.Application()
+        app.router.add_post("/v1/plate-reader/", slow)
+        async with TestServer(app) as server:
+            sdk_url = str(server.make_url("")).rstrip("/")
+            async with AsyncRecognitionClient(
+                sdk_url=sdk_url, retries=3, timeout=0.2
+            ) as client:
+                return await client.recognition(b"image")
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(recognize())
+    assert len(calls) == 1
+
+
+def test_async_run_writes_csv_in_file_order(tmp_path):
+    pytest.importorskip("aiohttp")
+    from aiohttp.test_utils import TestServer
+
+    from async_recognition import run
+
+    paths = []
+    for i in range(6):
+        paths.append(tmp_path / f"car{i}.jpg")
+        paths[-1].write_bytes(b"image")
+    calls = []
+
+    async def recognize():
+        async with TestServer(plate_reader_app([], calls)) as server:
+            args = argparse.Namespace(
+                files=paths,
+                api_key=None,
+                sdk_url=str(server.make_url("")).rstrip("/"),
+                concurrency=2,
+                rate=None,
+                regions=None,
+                camera_id=None,
+                mmc=False,
+                engine_config=None,
+                output_file=tmp_path / "results.csv",
+                format="csv",
+            )
+            await run(args, {})
+
+    asyncio.run(recognize())
+    rows = (tmp_path / "results.csv").read_text().splitlines()
+    assert rows[0].startswith("filename,")
+    assert [row.split(",")[0] for row in rows[1:]] == [path.name for path in paths]
+    assert len(calls) == 6
+
+
+def test_result_writer_rotates_compressed_jsonl_from_threads(tmp_path):
+    path = tmp_path / "results.jsonl.gz"
+    writer = ResultWriter(
+        path, "jsonl", flush_interval=0, append=True, compression="gzip", max_bytes=2000
+    )
+
+    def write(start):
+        for i in range(start, start + 250):
+            writer.write({"results": [], "index": i})
+
+    threads = [threading.Thread(target=write, args=(i * 250,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    writer.close()
+    files = sorted(tmp_path.glob("results*.jsonl.gz"))
+    assert len(files) > 1
+    indexes = []
+    for file in files:
+        with gzip.open(file, "rt") as fp:
+            indexes += [json.loads(line)["index"] for line in fp]
+    assert sorted(indexes) == list(range(1000))
+
+
+def test_result_writer_skips_api_errors_in_csv(tmp_path):
+    path = tmp_path / "results.csv"
+    with ResultWriter(path, "csv") as writer:
+        writer.write({"error": "Injected error"})
+        writer.write({"filename": "car.jpg", "results": []})
+    assert writer.count == 1
+    assert path.read_text().splitlines()[1].startswith("car.jpg,")
+
+
+def test_seen_files_only_returns_new_or_changed_files():
+    seen = SeenFiles()
+    modified = datetime(2024, 1, 1, 12, 0)
+    files = [["a.jpg", modified, 100], ["b.jpg", modified, 200]]
+    assert seen.new_files("/cam1", files) == files
+    seen.add("/cam1", files)
+    assert seen.new_files("/cam1/", files) == []
+
+    resized = ["a.jpg", modified, 101]
+    touched = ["b.jpg", modified + timedelta(seconds=1), 200]
+    added = ["c.jpg", modified, 300]
+    assert seen.new_files("/cam1", [resized, touched, added]) == [
+        resized,
+        touched,
+        added,
+    ]
+    seen.add("/cam1", [resized])
+    assert seen.new_files("/cam1", [resized, touched]) == [touched]
+    seen.remove(SeenFiles.path("/cam1", "a.jpg"))
+    assert seen.new_files("/cam1", [resized]) == [resized]
+    seen.close()
+
+
+def test_seen_files_range_query_is_limited_to_the_directory():
+    seen = SeenFiles()
+    modified = datetime(2024, 1, 1)
+    files = [["a.jpg", modified, 100]]
+    seen.add("/cam1", files)
+    seen.add("/cam10", [["b.jpg", modified, 100]])
+    seen.add("/cam1/sub", [["c.jpg", modified, 100]])
+    seen.add("/", [["d.jpg", modified, 100]])
+
+    assert seen.new_files("/cam1", files) == []
+    # Same names in a sibling directory sharing the prefix are not seen
+    assert seen.new_files("/cam10", files) == files
+    assert seen.new_files("/cam1", [["b.jpg", modified, 100]]) == [
+        ["b.jpg", modified, 100]
+    ]
+    assert seen.new_files("/cam1/sub", [["c.jpg", modified, 100]]) == []
+    assert seen.new_files(
+        "/", [["d.jpg", modified, 100], ["a.jpg", modified, 100]]
+    ) == [["a.jpg", modified, 100]]
+    seen.close()
+
+
+class FakeServer(FileTransferProcessor):
+    """
+    FileTransferProcessor over a dict of folders, counting its connections
+    """
+
+    folders: dict = {}
+    connections = 0
+
+    def connect(self):
+        type(self).connections += 1
+        self.cwd = "/"
+
+    def close(self):
+        self.close_download_connections()
+
+    def delete_file(self, file):
+        pass
+
+    def list_files(self):
+        return self.folders[self.cwd]
+
+    def set_ftp_binary_file(self, file, image):
+        image.write(self.folders[self.cwd][file])
+
+    def set_working_directory(self, path):
+        self.cwd = path
+
+    def get_working_directory(self):
+        return self.cwd
+
+    def retrieve_files(self):
+        nondirs = []
+        for name, content in self.folders[self.cwd].items():
+            nondirs.append([name, datetime(2024, 1, 1), len(content)])
+        return [], [], nondirs
+
+
+def fake_server(folders, **kwargs):
+    FakeServer.folders = folders
+    FakeServer.connections = 0
+    settings = dict(
+        delete=None,
+        download_workers=0,
+        recognition_workers=2,
+        queue_size=2,
+        spool_size=1,
+        regions=None,
+        api_key=None,
+        sdk_url="http://sdk",
+        camera_id=None,
+        timestamp=None,
+        mmc=False,
+    )
+    settings.update(kwargs)
+    processor = FakeServer(**settings)
+    processor.seen = SeenFiles()
+    return processor
+
+
+def test_pipeline_keeps_file_order_and_bounds_downloads(capsys):
+    names = [f"{i:02}.jpg" for i in range(30)]
+    processor = fake_server(
+        {"/cam": {name: name.encode() for name in names}},
+        download_workers=3,
+        recognition_workers=2,
+        queue_size=2,
+    )
+    processor.connect()
+    processor.set_working_directory("/cam")
+    lock = threading.Lock()
+    pending = [0]
+    most_pending = [0]
+    download = FileTransferProcessor.download
+
+    def counted_download(self, ftp_file):
+        image = download(self, ftp_file)
+        with lock:
+            pending[0] += 1
+            most_pending[0] = max(most_pending[0], pending[0])
+        return image
+
+    def slow_api(image, *args, **kwargs):
+        time.sleep(random.uniform(0, 0.01))
+        with lock:
+            pending[0] -= 1
+        return {"filename": kwargs["filename"], "results": []}
+
+    with mock.patch.object(FakeServer, "download", counted_download), mock.patch(
+        "ftp_and_sftp_processor.recognition_api", side_effect=slow_api
+    ):
+        processor.process_files(processor.retrieve_files()[2])
+    output = json.loads(capsys.readouterr().out)
+    assert [result["filename"] for result in output] == names
+    # Queued files, one held by each blocked download worker and the ones
+    # being recognized
+    assert most_pending[0] <= 2 + 3 + 2
+    processor.close()
+
+
+def test_pipeline_survives_a_failing_api(tmp_path):
+    names = [f"{i:02}.jpg" for i in range(12)]
+    processor = fake_server(
+        {"/cam": {name: name.encode() for name in names}},
+        download_workers=2,
+        recognition_workers=2,
+        queue_size=2,
+    )
+    processor.sink = ResultWriter(tmp_path / "results.csv", "csv")
+    processor.connect()
+    processor.set_working_directory("/cam")
+
+    def failing_api(image, *args, **kwargs):
+        index = int(kwargs["filename"][:2])
+        if index % 3 == 0:
+            raise ConnectionError("API down")
+        if index % 3 == 1:
+            return {"error": "Bad request"}
+        return {"filename": kwargs["filename"], "results": []}
+
+    write = ResultWriter.write
+
+    def failing_write(self, result):
+        if result.get("filename") in ("05.jpg", "08.jpg"):
+            raise OSError("No space left on device")
+        write(self, result)
+
+    with mock.patch.object(ResultWriter, "write", failing_write), mock.patch(
+        "ftp_and_sftp_processor.recognition_api", side_effect=failing_api
+    ):
+        thread = threading.Thread(
+            target=processor.process_files,
+            args=(processor.retrieve_files()[2],),
+            daemon=True,
+        )
+        thread.start()
+        thread.join(10)
+    assert not thread.is_alive(), "The pipeline is blocked"
+    processor.sink.close()
+    rows = (tmp_path / "results.csv").read_text().splitlines()[1:]
+    written = ["02.jpg", "11.jpg"]
+    assert sorted(row.split(",")[0] for row in rows) == written
+    # Only the files written to the sink are skipped at the next interval
+    remaining = processor.seen.new_files("/cam", processor.retrieve_files()[2])
+    assert sorted(info[0] for info in remaining) == sorted(set(names) - set(written))
+    processor.close()
+
+
+def test_process_cameras_interleaves_batches_of_cameras():
+    folders = {
+        "/cams/big": {f"big{i:02}.jpg": b"big" for i in range(10)},
+        "/cams/small": {f"small{i}.jpg": b"small" for i in range(3)},
+    }
+    processor = fake_server(folders, download_workers=2)
+    sink = mock.Mock()
+    processor.sink = sink
+    batches = []
+
+    def process_files(self, ftp_files):
+        batches.append((self.camera_id, len(ftp_files)))
+        return FileTransferProcessor.process_files(self, ftp_files)
+
+    args = argparse.Namespace(
+        download_workers=2,
+        camera_workers=1,
+        max_connections=None,
+        cameras_root="/cams",
+        camera_batch=3,
+    )
+    with mock.patch.object(FakeServer, "process_files", process_files), mock.patch(
+        "ftp_and_sftp_processor.recognition_api", return_value={"results": []}
+    ):
+        process_cameras(processor, args, ["big", "small"])
+    # The small camera does not wait for the backlog of the big one
+    assert batches == [("big", 3), ("small", 3), ("big", 3), ("big", 3), ("big", 1)]
+    assert sink.write.call_count == 13
+    # One camera connection and its download connections for all the batches
+    assert FakeServer.connections == 1 + 2
+    processor.set_working_directory("/cams/big")
+    assert processor.seen.new_files("/cams/big", processor.retrieve_files()[2]) == []
+
+
+def test_redaction_blur_only_changes_plate_boxes():
+    rng = random.Random(0)
+    image = Image.new("RGB", (200, 100))
+    image.putdata(
+        [tuple(rng.randrange(256) for _ in range(3)) for _ in range(200 * 100)]
+    )
+    boxes = [(10, 10, 50, 30), (40, 20, 80, 40), (150, 60, 190, 90)]
+    assert [len(members) for _, members in group_boxes(boxes)] == [2, 1]
+    results = [
+        dict(box=dict(zip(["xmin", "ymin", "xmax", "ymax"], b)), vehicle=dict(score=1))
+        for b in boxes
+    ]
+    blurred = blur(image.copy(), 5, dict(results=results))
+    mask = Image.new("L", image.size)
+    for b in boxes:
+        mask.paste(255, b)
+    difference = ImageChops.difference(image, blurred).convert("L")
+    assert ImageChops.multiply(difference, ImageChops.invert(mask)).getbbox() is None
+    for b in boxes:
+        assert difference.crop(b).getbbox() is not None
+
+
+def test_annotated_image_keeps_the_mode_of_the_file(tmp_path):
+    path = tmp_path / "car.png"
+    Image.new("RGBA", (200, 100), (10, 20, 30, 40)).save(path)
+    args = argparse.Namespace(
+        crop_lp=None, crop_vehicle=None, show_boxes=False, annotate_images=True
+    )
+    results = {
+        "results": [
+            {"box": dict(xmin=20, ymin=30, xmax=80, ymax=60), "plate": "abc123"}
+        ]
+    }
+    output_image(args, path, results, ImageContext(path))
+    annotated = Image.open(tmp_path / "car_annotated.png")
+    assert annotated.mode == "RGBA"
+    assert annotated.getpixel((150, 90)) == (10, 20, 30, 40)
+
+
+def test_split_adaptive_requires_split_image(capsys):
+    argv = ["-s", "http://sdk", "--split-adaptive", "car.jpg"]
+    with pytest.raises(SystemExit):
+        parse_arguments(custom_args, argv)
+    assert "--split-adaptive requires --split-image" in capsys.readouterr().err
+    args = parse_arguments(custom_args, argv + ["--split-image"])
+    assert args.split_adaptive and args.split_image
+
+
+def test_select_tiles_only_sends_tiles_near_uncertain_detections():
+    args = argparse.Namespace(split_min_megapixels=2.0, split_min_score=0.5)
+    tiles = [((0, 0), (0, 0, 2000, 2000)), ((2000, 0), (2000, 0, 4000, 2000))]
+    confident = dict(box=dict(xmin=100, ymin=100, xmax=400, ymax=200), score=0.9)
+    low_score = dict(box=dict(xmin=2100, ymin=100, xmax=2400, ymax=200), score=0.3)
+    small = dict(box=dict(xmin=100, ymin=100, xmax=140, ymax=110), score=0.9)
+
+    assert select_tiles(tiles, dict(results=[]), (1000, 1000), args) == []
+    assert select_tiles(tiles, dict(results=[]), (4000, 2000), args) == tiles
+    assert select_tiles(tiles, dict(results=[confident]), (4000, 2000), args) == []
+    assert (
+        select_tiles(tiles, dict(results=[confident, low_score]), (4000, 2000), args)
+        == tiles[1:]
+    )
+    assert select_tiles(tiles, dict(results=[small]), (4000, 2000), args) == tiles[:1]
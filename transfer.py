@@ -37,6 +37,13 @@ except ImportError:
     )
     exit(1)
 
+from plate_recognition import (
+    add_rate_limit_arguments,
+    configure_client,
+    get_client,
+    make_rate_limiter,
+)
+
 _queue = queue.Queue(256)  # type: ignore
 
 ##########################
@@ -111,6 +118,7 @@ If it the --api-url is not defined, the results will be saved in the output file
     parser.add_argument(
         "--output-file", help="Json file with response", type=str, required=False
     )
+    add_rate_limit_arguments(parser)
 
     return parser.parse_args()
 
@@ -160,23 +168,22 @@ def image_transfer(src_path, args):
 
 def alpr(path, args):
     print(f"Sending {path}")
+    # Rate limited and retried by the shared client
+    client = get_client()
     try:
         if "localhost" in args.alpr_api:
             time.sleep(1)  # Wait for the whole image to arrive
             with open(path, "rb") as fp:
-                response = requests.post(
-                    args.alpr_api, files=dict(upload=fp), timeout=10
-                )
+                response = client.post(args.alpr_api, files=dict(upload=fp), timeout=10)
         else:
             time.sleep(1)  # Wait for the whole image to arrive
             filename = os.path.basename(path)
-            response = requests.post(
-                args.alpr_api,
-                files=dict(
-                    upload=(filename, open(path, "rb"), "application/octet-stream")
-                ),
-                headers={"Authorization": "Token " + args.platerec_token},
-            )
+            with open(path, "rb") as fp:
+                response = client.post(
+                    args.alpr_api,
+                    files=dict(upload=(filename, fp, "application/octet-stream")),
+                    headers={"Authorization": "Token " + args.platerec_token},
+                )
 
     except requests.exceptions.Timeout:
         print("SDK: Timeout")
@@ -244,6 +251,7 @@ def main(args, debug=False):
         recursive=True,
     )
     observer.start()
+    configure_client(pool_size=args.workers, limiter=make_rate_limiter(args))
     for _ in range(args.workers):
         t = threading.Thread(target=worker, args=(args,))
         t.daemon = True
@@ -1,17 +1,26 @@
 import argparse
 import datetime
+import json
 import math
 import os
+import platform
+import socket
 import subprocess
 import time
 from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+from statistics import mean, median
 from timeit import default_timer
 
 import cv2
 import requests
 
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Benchmark Video Blur")
@@ -43,6 +52,19 @@ def parse_arguments():
         help="File to store benchmarking results",
         required=False,
     )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=5,
+        help="Number of times the video is processed for each sample. The "
+        "comparison of --json results needs at least 4 to detect a regression.",
+    )
+    parser.add_argument(
+        "--json",
+        help="Also write the results to this file in the format of "
+        "benchmark/bench_report.py, to compare runs.",
+        required=False,
+    )
     return parser.parse_args()
 
 
@@ -82,11 +104,98 @@ def write_results(args, results):
         for result in results:
             file.write(
                 "| {:>18} | {:>6} | {:>11} | {:>19.1f} |\n".format(
-                    length, result["rate"], result["size"], result["duration"]
+                    length, result["rate"], result["size"], median(result["durations"])
                 )
             )
 
 
+def percentile(values, p):
+    """
+    Nearest-rank percentile of sorted values, like benchmark/bench_report.py
+    """
+    return values[max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))]
+
+
+def cpu_usage(since):
+    """
+    Percentage of the CPUs used since the psutil.cpu_times() snapshot since
+    """
+    if since is None:
+        return None
+    now = psutil.cpu_times()
+    total = sum(now) - sum(since)
+    if total <= 0:
+        return 0.0
+    return (1 - (now.idle - since.idle) / total) * 100
+
+
+def services_rss():
+    """
+    Memory used by the video editor and the SDK, their containers run on this
+    machine
+    """
+    if psutil is None:
+        return None
+    rss = 0
+    for process in psutil.process_iter():
+        try:
+            cmdline = " ".join(process.cmdline())
+            if "video_editor.py" in cmdline or "main.py" in cmdline:
+                rss += process.memory_info().rss
+        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+            pass
+    return rss
+
+
+def write_json_results(args, results):
+    """
+    Same format as benchmark/bench_report.py, which is not importable from this
+    folder. The sample rate is part of the config.
+    """
+    report = dict(
+        schema=1,
+        benchmark="video-blur",
+        created=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        host=dict(
+            hostname=socket.gethostname(),
+            platform=platform.platform(),
+            python=platform.python_version(),
+            cpus=os.cpu_count(),
+            memory=psutil.virtual_memory().total if psutil else None,
+        ),
+        sdk_version=None,
+        arguments=vars(args),
+        results=[],
+    )
+    for result in results:
+        samples = sorted(duration * 1000 for duration in result["durations"])
+        report["results"].append(
+            dict(
+                image=os.path.basename(args.video),
+                resolution=None,
+                config=dict(sample=result["rate"]),
+                rate=None,
+                latency={
+                    "min": samples[0],
+                    "mean": mean(samples),
+                    "max": samples[-1],
+                    "p50": percentile(samples, 50),
+                    "p90": percentile(samples, 90),
+                    "p99": percentile(samples, 99),
+                    "p99.9": percentile(samples, 99.9),
+                },
+                samples=[duration * 1000 for duration in result["durations"]],
+                throughput=len(samples) / sum(result["durations"]),
+                errors=0.0,
+                cpu=result["cpu"],
+                rss=result["rss"],
+                output_size=result["size"],
+            )
+        )
+    with open(args.json, "w") as fp:
+        json.dump(report, fp, indent=2)
+
+
 def print_table(file_path):
     with open(file_path) as file:
         for line in file:
@@ -129,13 +238,21 @@ def convert_size(size_bytes):
 
 
 def benchmark(args, executor, sample_rate):
-    stats = list(
+    cpu_times = psutil.cpu_times() if psutil else None
+    durations = list(
         executor.map(
-            partial(call_duration, video_editor_url=args.video_editor_url), [args.video]
+            partial(call_duration, video_editor_url=args.video_editor_url),
+            [args.video] * args.iterations,
         )
     )
     file_size = os.path.getsize(args.blur_output)
-    yield dict(rate=sample_rate, size=convert_size(file_size), duration=max(stats))
+    yield dict(
+        rate=sample_rate,
+        size=convert_size(file_size),
+        durations=durations,
+        cpu=cpu_usage(cpu_times),
+        rss=services_rss(),
+    )
 
 
 def check_api_access(api_url, max_wait_time=60, poll_interval=2):
@@ -173,6 +290,7 @@ def main(args):
     number_strings = rate_string.split(",")
     sample_rates = [int(x) for x in number_strings]
 
+    all_results = []
     with ThreadPoolExecutor(max_workers=1) as executor:
         for sample_rate in sample_rates:
             # Read the existing env.txt file and remove any existing SAMPLE entry
@@ -208,6 +326,9 @@ def main(args):
 
             # Write benchmark results to file to save progress.
             write_results(args, results)
+            all_results += results
+            if args.json:
+                write_json_results(args, all_results)
 
         print_table(args.benchmark_results)
 